@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Created by: Simon Brunet 2013-07-10
+#
+# Notice: Do not in entirety or in part, copy, use, distribute, sell,
+#         reproduce or publish any of that code without prior authorization
+#         of the aforementionned author.
+#
+# Abstract:
+#   One time data migrations
+#
+###############################################################################
+
+# Remap the paths for deferred
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'Application')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'Db')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'Cache')))
+
+import Db
+import logging
+
+from google.appengine.api import datastore
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from Parameters import MIGRATION_BATCH_SIZE
+
+# Kinds that are now keyed by name (see Db._NamedModel)
+NAMED_KINDS = ["UdaUser", "User", "Group"]
+
+# MigrateNamedKeys
+#   Re-key the existing entities of a kind by their name, one batch per
+#   deferred task. The low level datastore API is used on purpose so that
+#   properties no longer part of the models are still readable, namely the
+#   old Group.users list which is moved to GroupMember entities.
+#   Once all the kinds are done, LEGACY_NAME_LOOKUP can be turned off.
+def MigrateNamedKeys(kind, cursor=None):
+    query = datastore.Query(kind, cursor=cursor)
+    entities = query.Get(MIGRATION_BATCH_SIZE)
+
+    migrated = []
+    legacy = []
+    for entity in entities:
+        if entity.key().name():
+            # Already keyed by name
+            continue
+        name = entity['name']
+        users = entity.pop('users', None)
+        new = datastore.Entity(kind, name=name)
+        new.update(entity)
+        migrated.append(new)
+        legacy.append(entity.key())
+        if users:
+            Db.Model('GroupMember').PutMembers(name, [str(u) for u in users])
+
+    if migrated:
+        datastore.Put(migrated)
+        datastore.Delete(legacy)
+        # Cached entities still hold the old keys, writing them back
+        # would recreate the legacy entities
+        memcache.delete_multi([entity['name'] for entity in migrated],
+                              namespace=kind)
+
+    if len(entities) < MIGRATION_BATCH_SIZE:
+        logging.info('Migration of %s completed' % kind)
+        return
+    deferred.defer(MigrateNamedKeys, kind, query.GetCursor())
+
+# MigrateMailContents
+#   Move the message of the mails delivered before the contents were shared
+#   to a MailContent of their own, one batch of mails per deferred task.
+#   The content is keyed by the id of its mail so that running a batch
+#   again overwrites it instead of leaving an orphan behind.
+def MigrateMailContents(cursor=None):
+    query = Db.Query("Mail")
+    if cursor:
+        query.with_cursor(cursor)
+    mails = query.fetch(MIGRATION_BATCH_SIZE)
+
+    legacy = [mail for mail in mails if mail.GetContentKey() is None]
+    contents = []
+    for mail in legacy:
+        contents.append(Db.Model('MailContent')(
+            key_name='mail|%d' % mail.key().id(), sender=mail.sender,
+            subject=mail.subject, message=mail.message, visible=mail.cc,
+            bcc=mail.bcc))
+    if legacy:
+        db.put(contents)
+        for mail, content in zip(legacy, contents):
+            mail.content = content
+            mail.message = None
+            mail.cc = []
+            mail.bcc = []
+        db.put(legacy)
+        # Cached mails still have no content
+        memcache.delete_multi([str(mail.key().id()) for mail in legacy],
+                              namespace='Mail')
+
+    if len(mails) < MIGRATION_BATCH_SIZE:
+        logging.info('Migration of the mail contents completed')
+        return
+    deferred.defer(MigrateMailContents, query.cursor())
+
+def MigrateAll():
+    for kind in NAMED_KINDS:
+        deferred.defer(MigrateNamedKeys, kind)
+    deferred.defer(MigrateMailContents)
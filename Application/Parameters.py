@@ -13,4 +13,26 @@
 
 # Global parameters used by the application
 INBOX_PAGE_RESULTS = 20
-MAX_CAS_RETRY = 10
\ No newline at end of file
+INBOX_BUFFER_SURPLUS = 10 # Mails cached past the first page to absorb deletes
+INBOX_PAGE_TTL = 60 # Seconds the older pages of an inbox stay cached
+MAX_CAS_RETRY = 10
+MAX_BATCH_PUT = 500 # Datastore limit of entities per batched put
+SEND_MAIL_SHARD_SIZE = MAX_BATCH_PUT # Recipients delivered per deferred task
+MAX_SHARD_RETRY = 5 # Retries of a shard before it is left for ResumeMail
+RESUME_MAIL_DELAY = 3600 # Seconds before the unfinished shards are resumed
+RESUME_BATCH_SIZE = 100 # Unfinished shards listed per deferred resume task
+GROUP_PAGE_SIZE = 1000 # Members fetched per query when iterating a group
+MIGRATION_BATCH_SIZE = 100 # Entities re-keyed per deferred migration task
+LEGACY_NAME_LOOKUP = True # Set to False once the migration is completed
+MAX_KEY_NAME = 500 # Key names must be shorter than that many bytes
+INSTANCE_CACHE_TTL = {'Group': 60} # Namespaces kept in process memory (sec)
+LEASE_TIME = 10 # Seconds a request can hold the refill of a memcache miss
+LEASE_POLL_DELAY = 0.05 # Seconds between checks while waiting for a refill
+LEASE_POLL_COUNT = 20 # Checks before giving up and refilling anyway
+STALE_TTL = {'Group': 600, 'Inbox': 60} # Stale copies served on refill (sec)
+UNREAD_COUNTER_SHARDS = 5 # Counter entities per user for the unread count
+RECONCILE_BATCH_SIZE = 100 # Users recounted per deferred reconciliation task
+MARKDOWN_EXTENSIONS = [] # Markdown extensions used to render the messages
+MARKDOWN_CONFIGS = {} # Configuration of those extensions
+MARKDOWN_LRU_SIZE = 100 # Rendered messages kept in process memory
+MARKDOWN_INSTRUMENT = False # Log the slowest Markdown stages of each message
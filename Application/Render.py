@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Created by: Simon Brunet 2013-07-16
+#
+# Notice: Do not in entirety or in part, copy, use, distribute, sell,
+#         reproduce or publish any of that code without prior authorization
+#         of the aforementionned author.
+#
+# Abstract:
+#   Rendering of the messages
+#
+###############################################################################
+
+import hashlib
+import logging
+import markdown
+import threading
+
+from Parameters import MARKDOWN_EXTENSIONS
+from Parameters import MARKDOWN_CONFIGS
+from Parameters import MARKDOWN_INSTRUMENT
+
+# Processors and inline patterns logged for each conversion
+LOGGED_STAGES = 5
+
+# Anything changing the output of the rendering must be part of the
+# fingerprint, so that a new version or configuration of Markdown doesn't
+# serve the html rendered by the previous one.
+FINGERPRINT = hashlib.sha1(repr((markdown.version, MARKDOWN_EXTENSIONS,
+                                 sorted(MARKDOWN_CONFIGS.items())))).hexdigest()
+
+# StageTimes
+#   Instrument of a Markdown instance (see Markdown.instrumented), which
+#   logs the slowest stages of each conversion. The parser and the inline
+#   treeprocessor are left out, their time is the one of the block
+#   processors and of the inline patterns.
+class _StageTimes(object):
+    def __init__(self):
+        super(_StageTimes, self).__init__()
+        self.times = []
+
+    def __call__(self, stage, name, time, before, after, attempts=None,
+                 hits=None):
+        if stage == 'parser' or (stage, name) == ('treeprocessor', 'inline'):
+            return
+        self.times.append((time, stage, name, attempts, hits))
+
+    def Log(self, text):
+        if not self.times:
+            return
+        slowest = sorted(self.times, reverse=True)[:LOGGED_STAGES]
+        self.times = []
+        logging.info('Markdown of %d chars, slowest stages: %s', len(text),
+                     ', '.join('%s %s %.1f ms%s' %
+                               (stage, name, time * 1e3,
+                                '' if attempts is None else
+                                ' (%d/%d hits)' % (hits, attempts))
+                               for time, stage, name, attempts, hits
+                               in slowest))
+
+# ConverterPool
+#   Building a Markdown instance builds its whole parser (processors,
+#   inline patterns and their regexes, extensions), which costs more than
+#   converting a message. Instances are thus built once per configuration
+#   and reused, after a reset() which clears the state of the previous
+#   conversion. A Markdown instance is not thread safe, so each thread
+#   takes its own out of the pool while converting. The pool grows up to
+#   the number of concurrent conversions of the instance.
+#   With a write function, the html is passed to it a piece at a time as it
+#   is serialized (see Markdown.convertStream) instead of being returned.
+#   With MARKDOWN_INSTRUMENT, the instances log their slowest stages.
+class _ConverterPool(object):
+    def __init__(self, **kwargs):
+        super(_ConverterPool, self).__init__()
+        self.kwargs = kwargs
+        self.free = []
+        self.lock = threading.Lock()
+        
+    def Convert(self, text, write=None):
+        with self.lock:
+            md = self.free.pop() if self.free else None
+        if md is None:
+            if MARKDOWN_INSTRUMENT:
+                md = markdown.Markdown(instrument=_StageTimes(), **self.kwargs)
+            else:
+                md = markdown.Markdown(**self.kwargs)
+        try:
+            if write is None:
+                return md.reset().convert(text)
+            md.reset().convertStream(text, write)
+        finally:
+            if md.instrument:
+                md.instrument.Log(text)
+            with self.lock:
+                self.free.append(md)
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+# Get the pool of a configuration, created the first time it is asked for
+def GetConverterPool(extensions=[], configs={}):
+    key = repr((extensions, sorted(configs.items())))
+    with _poolsLock:
+        if key not in _pools:
+            _pools[key] = _ConverterPool(extensions=extensions,
+                                         extension_configs=configs)
+        return _pools[key]
+
+# The pieces are joined once, rather than the whole html being copied to
+# strip the wrapper of the document and by each postprocessor
+def RenderMarkdown(text):
+    pool = GetConverterPool(MARKDOWN_EXTENSIONS, MARKDOWN_CONFIGS)
+    pieces = []
+    pool.Convert(text, pieces.append)
+    return u''.join(pieces)
+
+# Key of the rendered html of a text, see MemcacheMarkdown
+def HtmlKey(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(FINGERPRINT + text).hexdigest()
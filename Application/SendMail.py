@@ -19,20 +19,29 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'Cache')
 
 import Db
 import Memcache
+import jinja2
+import logging
+import datetime
 
 from google.appengine.ext import deferred
 
+from Parameters import MAX_SHARD_RETRY
+from Parameters import RESUME_MAIL_DELAY
+from Parameters import RESUME_BATCH_SIZE
+
 def ExpandGroups(memGroup, data):
     
-    expand = []
+    expand = set()
     for d in data:
-        users = memGroup.GetUsers(d)
-        if users:
-            for u in users:
-                expand.append(u)
+        if not d:
+            # Empty field, or ';;' in one
+            continue
+        users = memGroup.IterUsers(d)
+        if users is not None:
+            expand.update(users)
         else:
-            expand.append(d)
-    return list(set(expand))
+            expand.add(d)
+    return list(expand)
 
 # SendMail
 #   Allright, time to have a semantical debate.
@@ -49,7 +58,7 @@ def ExpandGroups(memGroup, data):
 #   So for now, the groups are evaluated only once the SendMail request
 #   is being processed by deferred.
 #   However! There is a known limitation at the moment.
-#   There are no guarantee that for each GetUsers() call, it would
+#   There are no guarantee that for each IterUsers() call, it would
 #   be done on the same Memcache or Db state...
 #   Nevertheless, that shouldn't be too much of an issue
 #   as the group or user management will eventually be consistent.
@@ -80,16 +89,96 @@ def SendMail(sender, to, cc, bcc, subject, message):
         recipients = list(set(recipients)) # Remove duplicates
         recipients = filter(len, recipients) # Remove empty strings
         
-        # Send a mail to all the recipients
-        for recipient in recipients:
-            cc = list(set(visible) - set([recipient])) # Remove receiver from CC
-            bcc = invisible # Pretty much kept for the records
-            data = {}
-            if subject:
-                data['subject'] = subject
-            if message:
-                data['message'] = message
-            Db.Model('Mail').PutMail(name=recipient, sender = sender, cc=cc, bcc = bcc, **data)
+        data = {}
+        if subject:
+            data['subject'] = subject
+        if message:
+            data['message'] = message
+        # The content is stored once and shared by all the recipients
+        content = Db.Model('MailContent').PutContent(sender=sender,
+                                                     visible=visible,
+                                                     bcc=invisible, **data)
+        # Checkpoint the dispatch before fanning out so that a failure
+        # in the middle can be resumed (see ResumeMail)
+        job = Db.Model('MailJob').PutJob(recipients, content=content)
+        DispatchJob(job)
+        # Render the message once for all the recipients. It is escaped
+        # the same way as in view.html so that the key matches.
+        Memcache.MemcacheMarkdown().GetHtml(jinja2.escape(content.message))
     except:
         # Could add some error handling stuff here
-        raise deferred.PermanentTaskFailure()
\ No newline at end of file
+        raise deferred.PermanentTaskFailure()
+
+# DispatchJob
+#   Send every unfinished shard of a job to its own deferred task.
+#   That way, delivering to a large group scales with the number of
+#   task workers instead of the size of the group.
+def DispatchJob(job):
+    for shard in job.GetUnfinishedShards():
+        deferred.defer(SendShard, shard.key())
+
+# ResumeMail
+#   Re-dispatch only the shards of a job that were not delivered.
+#   To be used once a shard ran out of retries (see ResumeStaleMail).
+def ResumeMail(jobKey):
+    job = Db.Model('MailJob').get(jobKey)
+    if job is None:
+        logging.error('Trying to resume a mail job that does not exist')
+        return
+    DispatchJob(job)
+
+# ResumeStaleMail
+#   Cron job, see cron.yaml. Resume the jobs that still have unfinished
+#   shards RESUME_MAIL_DELAY seconds after being sent, by then their shards
+#   are done retrying. The unfinished shards are listed one batch per
+#   deferred task. They come in key order, so the shards of a job are next
+#   to each other and a job is resumed once even if they span two batches.
+def ResumeStaleMail(cursor=None, lastJob=None):
+    query = Db.Query("MailShard", keys_only=True).filter('done =', False)
+    if cursor:
+        query.with_cursor(cursor)
+    keys = query.fetch(RESUME_BATCH_SIZE)
+    jobKeys = []
+    for key in keys:
+        if key.parent() != lastJob:
+            lastJob = key.parent()
+            jobKeys.append(lastJob)
+    stale = datetime.datetime.now() - \
+            datetime.timedelta(seconds=RESUME_MAIL_DELAY)
+    for job in Db.Model('MailJob').get(jobKeys):
+        if job and job.created < stale:
+            logging.info('Resuming mail job %s' % job.key())
+            deferred.defer(ResumeMail, job.key())
+    if len(keys) < RESUME_BATCH_SIZE:
+        return
+    deferred.defer(ResumeStaleMail, query.cursor(), lastJob)
+
+# SendShard
+#   Deliver the mail of a job to the recipients of one shard.
+#   Unlike SendMail, a failing shard is retried by deferred, up to
+#   MAX_SHARD_RETRY times. Past that, it is left unfinished for ResumeMail.
+#   Known limitation: a batched put failing halfway will deliver again to
+#   some recipients when retried since the shard is checkpointed once done.
+def SendShard(shardKey):
+    shard = Db.Model('MailShard').get(shardKey)
+    if shard is None or shard.done:
+        # Already delivered by a previous attempt
+        return
+    try:
+        key = shard.parent().GetContentKey()
+        # Only the summary is copied, the recipients read the body from
+        # the shared content
+        content = Memcache.MemcacheMail().GetContent(key)
+        mails = [dict(name=recipient, content=key, sender=content.sender,
+                      subject=content.subject)
+                 for recipient in shard.recipients]
+        # The whole shard is written in one batch
+        Db.Model('Mail').PutMails(mails)
+        shard.MarkDone()
+    except:
+        retry = int(os.environ.get('HTTP_X_APPENGINE_TASKRETRYCOUNT', 0))
+        if retry >= MAX_SHARD_RETRY:
+            logging.error('Giving up on shard %d of mail job %s'
+                          % (shard.index, shard.parent_key()))
+            raise deferred.PermanentTaskFailure()
+        raise
\ No newline at end of file
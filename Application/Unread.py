@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#
+# Created by: Simon Brunet 2013-07-12
+#
+# Notice: Do not in entirety or in part, copy, use, distribute, sell,
+#         reproduce or publish any of that code without prior authorization
+#         of the aforementionned author.
+#
+# Abstract:
+#   Maintenance of the unread mails counters
+#
+###############################################################################
+
+# Remap the paths for deferred
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'Application')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'Db')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'Cache')))
+
+import Db
+import logging
+
+from google.appengine.ext import deferred
+
+from Parameters import RECONCILE_BATCH_SIZE
+
+# ReconcileUnread
+#   Recount the unread mails of every user from the Db, one batch of users
+#   per deferred task, to correct the drift of the counters updated in batch.
+def ReconcileUnread(cursor=None):
+    query = Db.Query("User")
+    if cursor:
+        query.with_cursor(cursor)
+    users = query.fetch(RECONCILE_BATCH_SIZE)
+    for user in users:
+        Db.Model('UnreadCounter').Reconcile(user.name)
+    if len(users) < RECONCILE_BATCH_SIZE:
+        logging.info('Unread counters reconciled')
+        return
+    deferred.defer(ReconcileUnread, query.cursor())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Created by: Simon Brunet 2013-07-14
+#
+# Notice: Do not in entirety or in part, copy, use, distribute, sell,
+#         reproduce or publish any of that code without prior authorization
+#         of the aforementionned author.
+#
+# Abstract:
+#   Compact representation of the entities kept in memcache
+#
+###############################################################################
+
+import Db
+
+# Caching full db.Model instances means pickling the whole model machinery
+# along with every property. Instead, only the fields needed by the views
+# are put in memcache, as a plain tuple tagged with CACHE_VERSION, and read
+# back as light value objects. Anything tagged with another version (or not
+# tagged at all) is treated as a miss, so changing the fields of an entry
+# only requires bumping the version.
+CACHE_VERSION = 2
+
+# Entry
+#    Base of the value objects. The fields are the __slots__ of the entry,
+#    in the order they are encoded. Each entry class builds itself from its
+#    entity with a FromEntity class method.
+class _Entry(object):
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    # Get the entry of an entity, entries and None are left as is
+    @classmethod
+    def Convert(cls, data):
+        if data is None or isinstance(data, cls):
+            return data
+        return cls.FromEntity(data)
+
+    def ToTuple(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def Encode(self):
+        return (CACHE_VERSION,) + self.ToTuple()
+
+    @classmethod
+    def Decode(cls, data):
+        if type(data) is tuple and data and data[0] == CACHE_VERSION:
+            return cls(*data[1:])
+        return None
+
+##
+class MailEntry(_Entry):
+    __slots__ = ('id', 'name', 'content', 'viewed', 'created', 'sender',
+                 'subject')
+
+    @classmethod
+    def FromEntity(cls, mail):
+        key = mail.GetContentKey()
+        return cls(mail.key().id(), mail.name, key and str(key),
+                   mail.viewed, mail.created, mail.sender, mail.subject)
+
+    def GetContentKey(self):
+        return self.content
+
+##
+class ContentEntry(_Entry):
+    __slots__ = ('key', 'sender', 'subject', 'message', 'visible', 'bcc')
+
+    @classmethod
+    def FromEntity(cls, content):
+        return cls(str(content.key()), content.sender, content.subject,
+                   content.message, content.visible, content.bcc)
+
+    # CC as seen by one of the recipients
+    def GetCc(self, name):
+        return [user for user in self.visible if user != name]
+
+##
+class UserEntry(_Entry):
+    __slots__ = ('name', 'groups', 'admin')
+
+    @classmethod
+    def FromEntity(cls, user):
+        return cls(user.name, user.groups, user.admin)
+
+##
+class UdaUserEntry(_Entry):
+    __slots__ = ('name', 'password')
+
+    @classmethod
+    def FromEntity(cls, user):
+        return cls(user.name, user.password)
+
+##
+class GroupEntry(_Entry):
+    __slots__ = ('name',)
+
+    @classmethod
+    def FromEntity(cls, group):
+        return cls(group.name)
+
+    def GetUsers(self):
+        return list(Db.Model("Group").IterUsers(self.name))
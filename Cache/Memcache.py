@@ -14,11 +14,196 @@
 from google.appengine.api import memcache
 
 import Db
+import Codec
+import Render
+import os
+import time
+import hashlib
 import logging
+import threading
+import itertools
 import collections
 
 from Parameters import INBOX_PAGE_RESULTS
+from Parameters import INBOX_BUFFER_SURPLUS
+from Parameters import INBOX_PAGE_TTL
 from Parameters import MAX_CAS_RETRY
+from Parameters import INSTANCE_CACHE_TTL
+from Parameters import LEASE_TIME
+from Parameters import LEASE_POLL_DELAY
+from Parameters import LEASE_POLL_COUNT
+from Parameters import STALE_TTL
+from Parameters import MARKDOWN_LRU_SIZE
+
+from Codec import CACHE_VERSION
+from Codec import MailEntry
+
+# Names are restricted to [a-zA-Z0-9_-] and mail ids are numbers,
+# so the lease prefix can't collide with real keys
+LEASE_PREFIX = 'lease|'
+# Stale copies are kept in their own namespace
+STALE_PREFIX = 'Stale.'
+
+INBOX_DEQUE_LENGTH = INBOX_PAGE_RESULTS + INBOX_BUFFER_SURPLUS
+
+# LocalCache
+#   In-process cache sitting in front of memcache. During a request, the
+#   same keys are read over and over (IsAdmin in Handler.initialize, then
+#   GetUser, ValidUser...). Those repeated reads are now served from memory
+#   instead of doing a memcache RPC each time.
+#   Entries only live for the current request (identified by its log id),
+#   unless their namespace is listed in INSTANCE_CACHE_TTL, in which case
+#   they are shared by all the requests of the instance for that many
+#   seconds. Outside of a request (no log id), it is simply bypassed.
+#   Writes done through the Memcache classes (hence through the Db layer)
+#   update it, so it stays coherent within the instance.
+class _LocalCache(object):
+    def __init__(self):
+        super(_LocalCache, self).__init__()
+        self.request = threading.local()
+        self.instance = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+    def _RequestData(self):
+        requestId = os.environ.get('REQUEST_LOG_ID')
+        if requestId is None:
+            return None
+        if getattr(self.request, 'id', None) != requestId:
+            # New request, start over
+            self.request.id = requestId
+            self.request.data = {}
+        return self.request.data
+    
+    def Get(self, key, namespace=None):
+        data = self._RequestData()
+        if data is None:
+            return None
+        entry = (namespace, key)
+        if entry in data:
+            self.hits += 1
+            return data[entry]
+        if namespace in INSTANCE_CACHE_TTL:
+            with self.lock:
+                expires, value = self.instance.get(entry, (0, None))
+            if expires > time.time():
+                data[entry] = value
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+    
+    def Set(self, key, value, namespace=None):
+        data = self._RequestData()
+        if data is None or value is None:
+            self.Delete(key, namespace)
+            return
+        entry = (namespace, key)
+        data[entry] = value
+        if namespace in INSTANCE_CACHE_TTL:
+            expires = time.time() + INSTANCE_CACHE_TTL[namespace]
+            with self.lock:
+                self.instance[entry] = (expires, value)
+                
+    def Delete(self, key, namespace=None):
+        entry = (namespace, key)
+        data = self._RequestData()
+        if data is not None:
+            data.pop(entry, None)
+        with self.lock:
+            self.instance.pop(entry, None)
+            
+    def Clear(self):
+        self.request = threading.local()
+        with self.lock:
+            self.instance = {}
+            
+    # The counters are shared by all the threads of the instance
+    def GetStats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+localCache = _LocalCache()
+
+# LRUCache
+#   Bounded in-process cache shared by all the threads of the instance. Once
+#   full, the least recently used entry is evicted. Only meant for immutable
+#   data, such as the rendered messages, since it is never invalidated.
+class _LRUCache(object):
+    def __init__(self, size):
+        super(_LRUCache, self).__init__()
+        self.size = size
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        
+    def Get(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                # Most recently used
+                self.data[key] = value
+            return value
+    
+    def Set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.size:
+                self.data.popitem(last=False)
+                
+    def Clear(self):
+        with self.lock:
+            self.data.clear()
+
+htmlCache = _LRUCache(MARKDOWN_LRU_SIZE)
+
+# UserMails
+#   Deque of the most recent mails of a user, most recent first. It buffers
+#   INBOX_BUFFER_SURPLUS mails past the first page, so deleted mails can be
+#   removed in place without having to refill the deque from the Db.
+class UserMails(collections.deque):
+    def __init__(self, mails=(), maxlen=INBOX_DEQUE_LENGTH):
+        super(UserMails, self).__init__(mails, maxlen)
+        # True when the deque holds all the mails of the user
+        self.complete = False
+        
+    def AppendNew(self, mail):
+        if len(self) == self.maxlen:
+            # The oldest mail is about to be pushed out
+            self.complete = False
+        self.appendleft(MailEntry.Convert(mail))
+        
+    def Remove(self, ids):
+        mails = [mail for mail in self if mail.id not in ids]
+        self.clear()
+        self.extend(mails)
+        
+    def GetPage(self):
+        return list(itertools.islice(self, INBOX_PAGE_RESULTS))
+    
+    # Same interface as the entries of Codec.py
+    @classmethod
+    def Convert(cls, data):
+        return data
+    
+    def Encode(self):
+        return (CACHE_VERSION, self.complete, [mail.ToTuple() for mail in self])
+    
+    @classmethod
+    def Decode(cls, data):
+        if type(data) is tuple and data and data[0] == CACHE_VERSION:
+            deque = cls(MailEntry(*mail) for mail in data[2])
+            deque.complete = data[1]
+            return deque
+        return None
+
+# Representation in memcache of the data of each namespace (see Codec.py)
+CODECS = {'Mail'        : MailEntry,
+          'MailContent' : Codec.ContentEntry,
+          'User'        : Codec.UserEntry,
+          'UdaUser'     : Codec.UdaUserEntry,
+          'Group'       : Codec.GroupEntry,
+          'Inbox'       : UserMails}
 
 ##
 class _Memcache(object):
@@ -26,24 +211,144 @@ class _Memcache(object):
         super(_Memcache, self).__init__()
         self.cache = memcache.Client()
     
+    # Convert entities to the value objects cached for their namespace
+    def _Convert(self, data, namespace):
+        if namespace in CODECS:
+            return CODECS[namespace].Convert(data)
+        return data
+    
+    def _Encode(self, data, namespace):
+        if namespace in CODECS and data is not None:
+            return data.Encode()
+        return data
+    
+    def _Decode(self, data, namespace):
+        if namespace in CODECS and data is not None:
+            return CODECS[namespace].Decode(data)
+        return data
+    
     # Set an element in memcache
-    def _Set(self, key, data, **kwargs):
-        self.cache.set(key, data, **kwargs)
+    #   local: Also keep it in the local cache
+    # Returns the element as it is cached
+    def _Set(self, key, data, local=True, **kwargs):
+        namespace = kwargs.get('namespace')
+        data = self._Convert(data, namespace)
+        encoded = self._Encode(data, namespace)
+        self.cache.set(key, encoded, **kwargs)
+        if local:
+            localCache.Set(key, data, namespace)
+        if namespace in STALE_TTL and data is not None:
+            # Copy that can be served while the element is being refilled
+            self.cache.set(key, encoded, time=STALE_TTL[namespace],
+                           namespace=STALE_PREFIX + namespace)
+        return data
+    
+    # Set multiple elements in memcache in a single call
+    # Returns the elements as they are cached
+    def _SetMulti(self, mapping, **kwargs):
+        namespace = kwargs.get('namespace')
+        mapping = dict((key, self._Convert(data, namespace))
+                       for key, data in mapping.iteritems())
+        encoded = dict((key, self._Encode(data, namespace))
+                       for key, data in mapping.iteritems())
+        self.cache.set_multi(encoded, **kwargs)
+        for key, data in mapping.iteritems():
+            localCache.Set(key, data, namespace)
+        if namespace in STALE_TTL:
+            self.cache.set_multi(encoded, time=STALE_TTL[namespace],
+                                 namespace=STALE_PREFIX + namespace)
+        return mapping
+    
+    # Get an element from the local cache first, then from memcache
+    def _GetCached(self, key, namespace=None):
+        data = localCache.Get(key, namespace)
+        if data is None:
+            data = self._Decode(self.cache.get(key, namespace=namespace), namespace)
+            if data is not None:
+                localCache.Set(key, data, namespace)
+        return data
     
     # Get an element in memcache, if not, execute the query functor specified
     #   Note: Watch out with Query.run() as it's returning an iterable not data
     def _Get(self, key, query, update = False, namespace=None, *args, **kwargs):
-        data = self.cache.get(key, namespace=namespace)
-        if data is None or update:
-            data = query(*args, **kwargs)
-            self._Set(key, data, namespace=namespace)
+        data = None
+        if not update:
+            data = self._GetCached(key, namespace)
+        if data is None:
+            data = self._Refill(key, query, update, namespace, True, *args, **kwargs)
+        return data
+    
+    # Execute the query functor to refill a missing element. When a hot key
+    # goes missing, every request in flight would otherwise run the same
+    # query at once (dogpile). A short lived lease in memcache makes sure
+    # that only one of them refills the element. The others get the stale
+    # copy if there is one (see STALE_TTL), or wait for the refill.
+    # A forced update skips the lease since it must not see stale data.
+    def _Refill(self, key, query, update=False, namespace=None, local=True,
+                *args, **kwargs):
+        lease = LEASE_PREFIX + key
+        if update or self.cache.add(lease, 1, time=LEASE_TIME, namespace=namespace):
+            try:
+                data = query(*args, **kwargs)
+                data = self._Set(key, data, local, namespace=namespace)
+            finally:
+                if not update:
+                    self.cache.delete(lease, namespace=namespace)
+            return data
+        if namespace in STALE_TTL:
+            data = self.cache.get(key, namespace=STALE_PREFIX + namespace)
+            data = self._Decode(data, namespace)
+            if data is not None:
+                return data
+        for i in xrange(LEASE_POLL_COUNT):
+            time.sleep(LEASE_POLL_DELAY)
+            polled = self.cache.get_multi([key, lease], namespace=namespace)
+            data = self._Decode(polled.get(key), namespace)
+            if data is not None:
+                if local:
+                    localCache.Set(key, data, namespace)
+                return data
+            if lease not in polled:
+                # Refilled with nothing (ie: not in Db) or lease expired
+                break
+        data = query(*args, **kwargs)
+        return self._Set(key, data, local, namespace=namespace)
+
+    # Get many elements in memcache with a single call. The misses are all
+    # passed at once to the batch query functor, which must return the data
+    # in the same order as the keys it is given (None if not found).
+    # Returns a dictionary of the elements found.
+    def _GetMulti(self, keys, query, namespace=None):
+        data = {}
+        remote = []
+        for key in keys:
+            local = localCache.Get(key, namespace)
+            if local is None:
+                remote.append(key)
+            else:
+                data[key] = local
+        if remote:
+            cached = self.cache.get_multi(remote, namespace=namespace)
+            for key, d in cached.iteritems():
+                d = self._Decode(d, namespace)
+                if d is not None:
+                    localCache.Set(key, d, namespace)
+                    data[key] = d
+        missing = list(set(key for key in remote if key not in data))
+        if missing:
+            fetched = dict((key, d) for key, d in zip(missing, query(missing))
+                           if d is not None)
+            data.update(self._SetMulti(fetched, namespace=namespace))
         return data
 
     def _Delete(self, key, **kwargs):
-        self.cache.delete(key)
+        self.cache.delete(key, **kwargs)
+        localCache.Delete(key, kwargs.get('namespace'))
         
     def _DeleteMulti(self, keys, **kwargs):
-        self.cache.delete_multi(keys)
+        self.cache.delete_multi(keys, **kwargs)
+        for key in keys:
+            localCache.Delete(key, kwargs.get('namespace'))
         
 ##
 class MemcacheMail(_Memcache):
@@ -58,52 +363,169 @@ class MemcacheMail(_Memcache):
     def SetMail(self, mailId, mail):
         self._Set(mailId, mail, namespace='Mail')
         
+    def SetMails(self, mails):
+        self._SetMulti(mails, namespace='Mail')
+        
+    def SetContent(self, content):
+        self._Set(str(content.key()), content, namespace='MailContent')
+        
+    # Get the contents of many mails with one get_multi, the misses being
+    # filled with one batched datastore get.
+    # Returns the contents in the same order as the keys.
+    def GetContents(self, keys):
+        keys = [str(key) for key in keys]
+        query = Db.Model('MailContent').get
+        contents = self._GetMulti(keys, query, 'MailContent')
+        return [contents.get(key) for key in keys]
+    
+    def GetContent(self, key):
+        return self.GetContents([key])[0]
+    
+    # Content of a mail, legacy mails carry their own (see Db.Mail)
+    def GetMailContent(self, mail):
+        key = mail.GetContentKey()
+        if key is None:
+            entity = Db.Model('Mail').GetMailById(mail.id)
+            key = entity.GetContentKey()
+            if key is None:
+                return entity.GetLegacyContent()
+        return self.GetContent(key)
+        
+    # The deleted mails are removed from the inbox deque in place. The Db
+    # is only hit when less than a page of mails is left in the buffer.
     def DeleteMails(self, user, ids):
         self._DeleteMulti(ids, namespace='Mail')
+        ids = set(int(id) for id in ids)
+        retry = 0
+        while retry < MAX_CAS_RETRY:
+            deque = UserMails.Decode(self.cache.gets(user, namespace='Inbox'))
+            if deque is None:
+                # Will be refilled next time the inbox is viewed
+                return
+            deque.Remove(ids)
+            if len(deque) < INBOX_PAGE_RESULTS and not deque.complete:
+                break
+            if self.cache.cas(user, deque.Encode(), namespace='Inbox'):
+                self._CountInbox('absorbed')
+                return
+            retry += 1
         # Refresh Inbox view
+        self._CountInbox('refilled')
         self.GetUserMails(user, True)
         
+    # Count how the deletes are handled, to tune INBOX_BUFFER_SURPLUS
+    def _CountInbox(self, stat):
+        self.cache.incr(stat, namespace='InboxStats', initial_value=0)
+        
+    # Returns how many deletes were absorbed by the buffer and how many
+    # needed a refill from the Db
+    def GetInboxStats(self):
+        stats = self.cache.get_multi(['absorbed', 'refilled'],
+                                     namespace='InboxStats')
+        return {'absorbed': int(stats.get('absorbed', 0)),
+                'refilled': int(stats.get('refilled', 0))}
+        
+    # Get a page of the inbox of a user and the cursor of the next one.
+    # The first page comes from the deque. The older ones are queried with
+    # datastore cursors and cached per cursor for INBOX_PAGE_TTL seconds.
+    # Raises ValueError if the cursor is invalid.
+    def GetInbox(self, user, cursor=None):
+        if not cursor:
+            deque = self.GetUserMails(user)
+            mails = deque.GetPage()
+            if len(deque) > len(mails) or \
+               (mails and len(mails) == INBOX_PAGE_RESULTS and not deque.complete):
+                return mails, Db.Model('Mail').GetCursor(mails[-1])
+            return mails, None
+        # Cursors are too long to be used as keys
+        key = hashlib.sha1('%s|%s' % (user, cursor)).hexdigest()
+        page = self.cache.get(key, namespace='InboxPage')
+        if type(page) is tuple and page[0] == CACHE_VERSION:
+            return [MailEntry(*mail) for mail in page[2]], page[1]
+        mails, next = Db.Model('Mail').GetMailPage(user, cursor)
+        mails = self._Summarize([MailEntry.Convert(mail) for mail in mails])
+        page = (CACHE_VERSION, next, [mail.ToTuple() for mail in mails])
+        self.cache.set(key, page, time=INBOX_PAGE_TTL, namespace='InboxPage')
+        return mails, next
+        
+    # The deque is kept out of the local cache since it is maintained
+    # with CAS (see SetUsersMails).
     def GetUserMails(self, user, update = False):
-        deque = self.cache.get(user, namespace='UserMails')
-        if deque is None or update:
-            data = Db.Model('Mail').GetRecentMail(user)
-            # Store the recent mails in a circular queue so that
-            # every new mail will simply refresh the queue
-            deque = collections.deque(data, maxlen=INBOX_PAGE_RESULTS)
-            self.cache.set(user, deque, namespace='UserMails')
+        deque = None
+        if not update:
+            deque = UserMails.Decode(self.cache.get(user, namespace='Inbox'))
+        if deque is None:
+            deque = self._Refill(user, self._QueryUserMails, update,
+                                 'Inbox', False, user)
         return deque
     
-    def SetUserMails(self, user, mail):
+    def _QueryUserMails(self, user):
+        data = Db.Model('Mail').GetRecentMail(user, INBOX_DEQUE_LENGTH)
+        # Store the recent mails in a circular queue so that
+        # every new mail will simply refresh the queue
+        deque = UserMails(self._Summarize([MailEntry.Convert(mail)
+                                           for mail in data]))
+        # Got less than asked, the Db has nothing more
+        deque.complete = len(data) < INBOX_DEQUE_LENGTH
+        return deque
+    
+    # Mails delivered before the summary was copied to them get it from
+    # their contents, read in batch.
+    def _Summarize(self, mails):
+        legacy = [mail for mail in mails
+                  if mail.sender is None and mail.content]
+        if legacy:
+            contents = self.GetContents([mail.content for mail in legacy])
+            for mail, content in zip(legacy, contents):
+                if content:
+                    mail.sender = content.sender
+                    mail.subject = content.subject
+        return mails
+    
+    # Append new mails to the deques of their users with CAS. All the users
+    # are done at once so that a bulk delivery costs one gets and one cas
+    # round trip per retry.
+    def SetUsersMails(self, mails):
+        userMails = collections.defaultdict(list)
+        for mail in mails:
+            userMails[mail.name].append(mail)
+        users = userMails.keys()
         retry = 0
-        # TODO brunets 2013-06-30 Handle case where max retry failed
-        while retry < MAX_CAS_RETRY:
-            deque = self.cache.gets(user, namespace='UserMails')
-            if deque is None:
-                # Why bother refreshing the cache if the user has
-                # no mails or if he never viewed them.
-                # It is not worth hitting the database or maintaining
-                # the cache for a dead user.
-                return
-            deque.appendleft(mail)
-            if self.cache.cas(user, deque, namespace='UserMails'):
-                break
+        while users and retry < MAX_CAS_RETRY:
+            # Users missing from the result have no deque to maintain
+            deques = self.cache.get_multi(users, namespace='Inbox',
+                                          for_cas=True)
+            encoded = {}
+            for user, deque in deques.iteritems():
+                deque = UserMails.Decode(deque)
+                if deque is None:
+                    continue
+                for mail in userMails[user]:
+                    deque.AppendNew(mail)
+                encoded[user] = deque.Encode()
+            # Only retry the users whose compare failed
+            users = self.cache.cas_multi(encoded, namespace='Inbox')
             retry += 1
+        if users:
+            # Out of retries, drop the deques rather than leave them without
+            # the new mails. They are refilled the next time they are viewed.
+            logging.warning('Inbox of %d users not updated, too much contention'
+                            % len(users))
+            self.cache.delete_multi(users, namespace='Inbox')
             
     def SetUserMailViewed(self, user, mailId):
         retry = 0
         # TODO brunets 2013-06-30 Handle case where max retry failed
         while retry < MAX_CAS_RETRY:
-            deque = self.cache.gets(user, namespace='UserMails')
+            deque = UserMails.Decode(self.cache.gets(user, namespace='Inbox'))
             if deque is None:
                 # Should never come here...
                 logging.error('Trying to update something that is not...')
                 return
-            newDeque = collections.deque(maxlen=INBOX_PAGE_RESULTS)
             for mail in deque:
-                if mail.key().id() == mailId:
+                if mail.id == mailId:
                     mail.viewed = True
-                newDeque.append(mail)
-            if self.cache.cas(user, newDeque, namespace='UserMails'):
+            if self.cache.cas(user, deque.Encode(), namespace='Inbox'):
                 break
             retry += 1
             
@@ -126,7 +548,7 @@ class MemcacheUser(_Memcache):
             return user.admin
         
     def ValidUser(self, name):
-        user = self.cache.get(name, namespace='User')
+        user = self._GetCached(name, namespace='User')
         if user:
             return True
         user = Db.Model("User").GetUser(name)
@@ -136,6 +558,13 @@ class MemcacheUser(_Memcache):
             return True
         return False
     
+    # Bulk version of ValidUser, one get_multi and at most one batched
+    # datastore get no matter how many names.
+    # Returns the set of the names that are valid users.
+    def ValidUsers(self, names):
+        query = Db.Model("User").GetMany
+        return set(self._GetMulti(names, query, 'User'))
+    
 ##
 class MemcacheUdaUser(_Memcache):
     
@@ -150,7 +579,7 @@ class MemcacheUdaUser(_Memcache):
         return self._Get(name, query, update, 'UdaUser', name)
     
     def UserTaken(self, name):
-        user = self.cache.get(name, namespace='UdaUser')
+        user = self._GetCached(name, namespace='UdaUser')
         if user:
             return True
         user = Db.Model("UdaUser").GetUdaUser(name)
@@ -173,12 +602,12 @@ class MemcacheGroup(_Memcache):
         query = Db.Model("Group").GetGroup
         return self._Get(name, query, update, 'Group', name)
     
-    def GetUsers(self, name):
-        group = self.GetGroup(name)
-        if group:
-            # WARNING! GAE stores element in a ListStringProperty in unicode.
-            # Must convert back to string.
-            return [str(user) for user in group.users]
+    # The members are not cached since a group such as Udacity would not
+    # fit in a memcache value. They are streamed from the Db page by page.
+    # Returns None if the group does not exist.
+    def IterUsers(self, name):
+        if self.ValidGroup(name):
+            return Db.Model("Group").IterUsers(name)
     
     def ValidGroup(self, name):
         group = self.GetGroup(name)
@@ -187,3 +616,50 @@ class MemcacheGroup(_Memcache):
         return False
     
     
+    
+    # Same as MemcacheUser.ValidUsers, for groups
+    def ValidGroups(self, names):
+        query = Db.Model("Group").GetMany
+        return set(self._GetMulti(names, query, 'Group'))
+            
+##
+class MemcacheMarkdown(_Memcache):
+    
+    def __init__(self):
+        super(MemcacheMarkdown, self).__init__()
+        
+    # Rendered html of a text, keyed by the hash of the text and of the
+    # Markdown configuration (see Render.py). Since the key changes with
+    # the text, entries never have to be invalidated.
+    # Also used as the markdown filter of the templates.
+    def GetHtml(self, text):
+        key = Render.HtmlKey(text)
+        html = htmlCache.Get(key)
+        if html is None:
+            html = self.cache.get(key, namespace='Markdown')
+            if html is None:
+                html = Render.RenderMarkdown(text)
+                self.cache.set(key, html, namespace='Markdown')
+            htmlCache.Set(key, html)
+        return html
+    
+##
+class MemcacheUnread(_Memcache):
+    
+    def __init__(self):
+        super(MemcacheUnread, self).__init__()
+        
+    def SetUnread(self, name, count):
+        self._Set(name, count, namespace='Unread')
+        
+    def GetUnread(self, name, update=False):
+        query = Db.Model('UnreadCounter').GetCount
+        return self._Get(name, query, update, 'Unread', name)
+    
+    # Add to the cached counts of many users (dictionary of name to delta).
+    # Counts that are not cached are left alone, they will be summed from
+    # the counter shards the next time they are read.
+    def AddUnread(self, deltas):
+        self.cache.offset_multi(deltas, namespace='Unread')
+        for name in deltas:
+            localCache.Delete(name, 'Unread')
\ No newline at end of file
@@ -16,8 +16,18 @@ from google.appengine.ext import db
 import Memcache
 import Hashing
 import logging
+import random
+import calendar
+import datetime
+import collections
 
 from Parameters import INBOX_PAGE_RESULTS
+from Parameters import SEND_MAIL_SHARD_SIZE
+from Parameters import MAX_BATCH_PUT
+from Parameters import GROUP_PAGE_SIZE
+from Parameters import LEGACY_NAME_LOOKUP
+from Parameters import MAX_KEY_NAME
+from Parameters import UNREAD_COUNTER_SHARDS
 
 # BaseModel
 #    Generic interface used for all entities
@@ -38,41 +48,80 @@ class _BaseModel(db.Model):
         except db.NotSavedError:
             logging.error('Trying to delete an object that is not')
 
+# NamedModel
+#    Entities keyed by their name. A lookup is then a direct key get instead
+#    of an indexed (and only eventually consistent) query on the name.
+class _NamedModel(_BaseModel):
+    
+    @classmethod
+    def _PutNamed(cls, name, **kwargs):
+        return cls._Put(key_name=name, name=name, **kwargs)
+    
+    @classmethod
+    def GetByName(cls, name):
+        return cls.GetMany([name])[0]
+    
+    # The datastore rejects empty, reserved (__*__) and too long key names.
+    # No entity can be named that way, so they are simply not found.
+    @staticmethod
+    def ValidName(name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return isinstance(name, str) and 0 < len(name) < MAX_KEY_NAME and \
+               not (name.startswith('__') and name.endswith('__'))
+    
+    # Batch lookup, returns the entities (or None) in the order of the names
+    @classmethod
+    def GetMany(cls, names):
+        objs = [None] * len(names)
+        valid = [i for i, name in enumerate(names) if cls.ValidName(name)]
+        if not valid:
+            return objs
+        found = cls.get_by_key_name([names[i] for i in valid])
+        for i, obj in zip(valid, found):
+            objs[i] = obj
+        if LEGACY_NAME_LOOKUP:
+            # Entities that were not re-keyed yet (see Migration.py)
+            for i in valid:
+                if objs[i] is None:
+                    objs[i] = Query(cls.kind()).filter('name =', names[i]).get()
+        return objs
+
 # UdaUser
 #    Stub entity used to simulate the Udacity User base.
 #    This is just the most basic interface required.
 #    Simply needs to replace this stub with the real database if this (UdaMail)
 #    module is added.
-class UdaUser(_BaseModel):
+class UdaUser(_NamedModel):
     name = db.StringProperty(required=True, indexed=True)
     password = db.StringProperty(required=True)
     
     @classmethod
     def GetUdaUser(cls, name):
-        return Query("UdaUser").filter('name =', name).get()
+        return cls.GetByName(name)
     
     @classmethod
     def CreateUdaUser(cls, name, password, admin=False):
         # Automatically create a corresponding UdaMail user
         User.CreateUser(name, admin)
-        user = cls._Put(name=name, password=Hashing.GetPwHash(password))
+        user = cls._PutNamed(name, password=Hashing.GetPwHash(password))
         # Refresh Memcache
         Memcache.MemcacheUdaUser().SetUser(name, user)
 
 # User
 #    User entity of UdaMail
-class User(_BaseModel):
+class User(_NamedModel):
     name = db.StringProperty(required=True, indexed=True)
     groups = db.StringListProperty(required=True, default=["Udacity"])
     admin = db.BooleanProperty(required = True, default=False)
     
     @classmethod
     def GetUser(cls, name):
-        return Query("User").filter('name =', name).get()
+        return cls.GetByName(name)
     
     @classmethod
     def CreateUser(cls, name, admin=False):
-        user = cls._Put(name=name, admin=admin)
+        user = cls._PutNamed(name, admin=admin)
         # Refresh Memcache
         Memcache.MemcacheUser().SetUser(name, user)
         # Since he's part of Udacity group, add him to it
@@ -85,21 +134,97 @@ class User(_BaseModel):
         Memcache.MemcacheUser().SetUser(self.name, self)
     
     
-# Mail
-#    Mail model. Mail entries must have the following infos
-class Mail(_BaseModel):
-    name = db.StringProperty(required=True, indexed=True)  # (To)
+# MailContent
+#    Content of a message. It is written once per message no matter how
+#    many recipients it has. Each recipient only gets a small Mail entity
+#    pointing at it, so a broadcast to Udacity no longer writes (nor caches)
+#    the same body thousands of times.
+#    Note: a content is not deleted along with the mails pointing at it.
+class MailContent(_BaseModel):
     sender = db.StringProperty(required=True, indexed=True) # (From)
     subject = db.StringProperty(required=True, default="(No Subject)")
     message = db.TextProperty(required=True, default="EOM")
-    cc = db.StringListProperty(required=True, default=[]) # (CC)
+    visible = db.StringListProperty(required=True, default=[]) # (To + CC)
     bcc = db.StringListProperty(required=True, default=[]) # (BCC)
+    
+    @classmethod
+    def PutContent(cls, **kwargs):
+        content = cls._Put(**kwargs)
+        # Refresh memcache, all the recipients are about to read it
+        Memcache.MemcacheMail().SetContent(content)
+        return content
+    
+    # CC as seen by one of the recipients
+    def GetCc(self, name):
+        return [user for user in self.visible if user != name]
+    
+# Mail
+#    Delivery of a MailContent to one recipient. The sender and subject are
+#    copied at delivery time so that the inbox is listed from the mails
+#    alone, the content (and its body) is only read when a mail is viewed.
+#    Mails delivered before have no summary, see MemcacheMail._Summarize().
+#    Mails delivered before the contents were shared have no content but
+#    hold the message themselves, until Migration.MigrateMailContents()
+#    moves it to a MailContent.
+class Mail(_BaseModel):
+    name = db.StringProperty(required=True, indexed=True)  # (To)
+    content = db.ReferenceProperty(MailContent)
     viewed = db.BooleanProperty(required = True, default=False)
+    sender = db.StringProperty(indexed=False)  # Summary of the content
+    subject = db.StringProperty(indexed=False)
+    message = db.TextProperty()  # Legacy content
+    cc = db.StringListProperty()
+    bcc = db.StringListProperty()
+    
+    # Key of the content without fetching it, None for legacy mails.
+    # Use MemcacheMail.GetContents() to read the contents in batch.
+    def GetContentKey(self):
+        return Mail.content.get_value_for_datastore(self)
+    
+    # Content of a legacy mail, built from its own fields. It is not saved.
+    # The receiver was already removed from the CC at delivery time.
+    def GetLegacyContent(self):
+        return MailContent(sender=self.sender, subject=self.subject,
+                           message=self.message, visible=self.cc,
+                           bcc=self.bcc)
     
     @classmethod
-    def GetRecentMail(cls, name):
+    def GetRecentMail(cls, name, limit=INBOX_PAGE_RESULTS):
         return Query("Mail").order('-created').filter('name =', name)\
-                    .fetch(INBOX_PAGE_RESULTS)
+                    .fetch(limit)
+    
+    # Inbox cursors are opaque strings made of the creation time of the
+    # last mail of the first page (the first page is served from memcache,
+    # see MemcacheMail.GetInbox) and of the datastore cursor of the query
+    # of the older mails, if a page of them was already fetched.
+    # Cursor of the page following a given mail
+    @classmethod
+    def GetCursor(cls, mail):
+        created = mail.created
+        us = calendar.timegm(created.utctimetuple()) * 1000000 + created.microsecond
+        return '%d:' % us
+    
+    # Get a page of mails following an inbox cursor. Uses the same
+    # (name, -created) index as GetRecentMail.
+    # Returns the mails and the cursor of the next page (None when done)
+    @classmethod
+    def GetMailPage(cls, name, cursor, limit=INBOX_PAGE_RESULTS):
+        try:
+            us, queryCursor = cursor.split(':', 1)
+            us = int(us)
+            before = datetime.datetime.utcfromtimestamp(us // 1000000)
+            before = before.replace(microsecond=us % 1000000)
+            query = Query("Mail").filter('name =', name)\
+                        .filter('created <', before).order('-created')
+            if queryCursor:
+                query.with_cursor(queryCursor)
+            mails = query.fetch(limit)
+        except (ValueError, db.BadArgumentError, db.BadRequestError,
+                db.BadValueError):
+            raise ValueError('Invalid inbox cursor')
+        if len(mails) < limit:
+            return mails, None
+        return mails, '%d:%s' % (us, query.cursor())
     
     @classmethod
     def GetMailById(cls, id):
@@ -107,41 +232,134 @@ class Mail(_BaseModel):
     
     @classmethod
     def PutMail(cls, **kwargs):
-        mail = cls._Put(**kwargs)
+        return cls.PutMails([kwargs])[0]
+    
+    # Bulk delivery. The mails are built in memory and written with one
+    # batched put per MAX_BATCH_PUT entities instead of one round trip
+    # per mail. Memcache is then refreshed with multi calls as well.
+    # The summary is taken from the content when it is given as an entity.
+    @classmethod
+    def PutMails(cls, mails):
+        for kwargs in mails:
+            content = kwargs['content']
+            if isinstance(content, MailContent):
+                kwargs.setdefault('sender', content.sender)
+                kwargs.setdefault('subject', content.subject)
+        mails = [cls(**kwargs) for kwargs in mails]
+        for start in xrange(0, len(mails), MAX_BATCH_PUT):
+            db.put(mails[start:start + MAX_BATCH_PUT])
         # Refresh memcache
         memMail = Memcache.MemcacheMail()
-        memMail.SetMail(str(mail.key().id()), mail)
-        memMail.SetUserMails(kwargs['name'], mail)
+        memMail.SetMails(dict((str(mail.key().id()), mail) for mail in mails))
+        memMail.SetUsersMails(mails)
+        UnreadCounter.AddCounts(collections.Counter(mail.name for mail in mails))
+        return mails
         
     @classmethod
     def DeleteMails(cls, user, ids):
         # Delete all mails from Db before refreshing memcache so that the
-        # database will only get hit once to refresh the deque.
-        # This could be optimized by buffering extra mails in the deque in
-        # memcache and then remove the deleted mails from the deque and
-        # only refresh if len(deque) < INBOX_PAGE_RESULTS.
-        # The deque is refilled anytime a mail is received.
-        # That way, it could be possible to never have to hit the database
-        # to refresh the cache.
-        # However, I don't have stats to assess if this is really
-        # optimizing the process or just adding some overhead.
-        # Neither would I have a good value for the deque length.
-        # Nevertheless, this would most likely be preferable as doing a
-        # hit everytime a single mail is deleted.
-        # TODO brunets 2013-07-01 Implement such logic
+        # database will only get hit once if the deque must be refilled.
+        # The deque buffers INBOX_BUFFER_SURPLUS extra mails, so most of
+        # the time the deleted mails are simply removed from it.
+        # See MemcacheMail.GetInboxStats() to tune the buffer size.
         memMail = Memcache.MemcacheMail()
+        unread = 0
+        keys = []
         for id in ids:
             mail = memMail.GetMail(id)
-            if mail:
-                mail._delete()
+            # Only the owner can delete his mails
+            if mail and mail.name == user:
+                keys.append(db.Key.from_path(cls.kind(), mail.id))
+                if not mail.viewed:
+                    unread += 1
+        db.delete(keys)
         # Remove from memcache
         memMail.DeleteMails(user, ids)
+        if unread:
+            UnreadCounter.AddCounts({user: -unread})
+        
+    @classmethod
+    def SetMailViewed(cls, user, id):
+        mail = cls.get_by_id(id)
+        if mail:
+            mail.SetViewed(user)
         
     def SetViewed(self, user):
+        if self.viewed:
+            # Nothing to update
+            return
         self.viewed = True
         self.put()
         # Refresh memcache
-        Memcache.MemcacheMail().SetUserMailViewed(user, self.key().id())
+        memMail = Memcache.MemcacheMail()
+        memMail.SetMail(str(self.key().id()), self)
+        memMail.SetUserMailViewed(user, self.key().id())
+        UnreadCounter.AddCounts({user: -1})
+    
+# UnreadCounter
+#    Count of the unread mails of a user, so that it can be shown on every
+#    page without scanning the mailbox. It is split in UNREAD_COUNTER_SHARDS
+#    entities so that a burst of mails to the same user doesn't contend on
+#    a single one. The total is cached by MemcacheUnread.
+#    Counts updated in batch are not transactional, so Reconcile() is run
+#    periodically (see cron.yaml) to correct any drift.
+class UnreadCounter(_BaseModel):
+    count = db.IntegerProperty(required=True, default=0, indexed=False)
+    
+    @staticmethod
+    def _KeyName(name, shard):
+        return '%s|%d' % (name, shard)
+    
+    @classmethod
+    def GetCount(cls, name):
+        keyNames = [cls._KeyName(name, i) for i in xrange(UNREAD_COUNTER_SHARDS)]
+        return sum(counter.count for counter in cls.get_by_key_name(keyNames)
+                   if counter)
+    
+    @classmethod
+    def _AddCount(cls, keyName, delta):
+        counter = cls.get_by_key_name(keyName)
+        if counter is None:
+            counter = cls(key_name=keyName)
+        counter.count += delta
+        counter.put()
+    
+    # Add to the counts of many users (dictionary of name to delta).
+    # A single user is updated in a transaction, many users are updated
+    # with one batched get and put.
+    @classmethod
+    def AddCounts(cls, deltas):
+        keyNames = dict((cls._KeyName(name, random.randrange(UNREAD_COUNTER_SHARDS)),
+                         delta) for name, delta in deltas.iteritems() if delta)
+        if len(keyNames) == 1:
+            db.run_in_transaction(cls._AddCount, *keyNames.items()[0])
+        elif keyNames:
+            names = keyNames.keys()
+            counters = []
+            for start in xrange(0, len(names), MAX_BATCH_PUT):
+                batch = names[start:start + MAX_BATCH_PUT]
+                for keyName, counter in zip(batch, cls.get_by_key_name(batch)):
+                    if counter is None:
+                        counter = cls(key_name=keyName)
+                    counter.count += keyNames[keyName]
+                    counters.append(counter)
+            for start in xrange(0, len(counters), MAX_BATCH_PUT):
+                db.put(counters[start:start + MAX_BATCH_PUT])
+        # Refresh memcache
+        Memcache.MemcacheUnread().AddUnread(deltas)
+    
+    # Recount the unread mails of a user from the Db
+    @classmethod
+    def Reconcile(cls, name):
+        count = Query("Mail").filter('name =', name).filter('viewed =', False)\
+                    .count(limit=None)
+        counters = [cls(key_name=cls._KeyName(name, i))
+                    for i in xrange(UNREAD_COUNTER_SHARDS)]
+        counters[0].count = count
+        db.put(counters)
+        # Refresh memcache
+        Memcache.MemcacheUnread().SetUnread(name, count)
+        return count
     
     
     
@@ -165,17 +383,21 @@ class Mail(_BaseModel):
 #    Finally, groups are not expected to change frequently. Therefore,
 #    write operations will not be performed too often so it should not
 #    lead to extraordinary costs.
-class Group(_BaseModel):
+#    Note: the members are not stored in the group itself anymore but as
+#    GroupMember entities. A single list holding every member of Udacity
+#    would have to be read and rewritten at every signup and would
+#    eventually hit the entity size limit.
+class Group(_NamedModel):
     name = db.StringProperty(required=True, indexed=True) # Group name
-    users = db.StringListProperty(required=True, default=[])
     
     @classmethod
     def GetGroup(cls, name):
-        return Query("Group").filter('name =', name).get()
+        return cls.GetByName(name)
     
     @classmethod
     def PutGroup(cls, name, users=[]):
-        group = cls._Put(name=name, users=users)
+        group = cls._PutNamed(name)
+        GroupMember.PutMembers(name, users)
         # Refresh Memcache
         Memcache.MemcacheGroup().SetGroup(name, group)
         
@@ -186,10 +408,8 @@ class Group(_BaseModel):
             # Should happen once and only once
             cls.PutGroup("Udacity", [user])
         else:
-            users = group.users
-            users.append(user)
-            users = list(set(users)) # Remove duplicates
-            group.UpdateGroup(users)
+            # Membership is keyed by name, adding twice is harmless
+            GroupMember.PutMembers("Udacity", [user])
         
     @classmethod
     def AddUser(cls, name, username):
@@ -202,12 +422,9 @@ class Group(_BaseModel):
         if group is None:
             cls.PutGroup(name, [username])
         else:
-            users = group.users
-            users.append(username)
-            users = list(set(users)) # Remove duplicates
-            group.UpdateGroup(users)
-        # Maintain user
-        user = Memcache.MemcacheUser().GetUser(username)
+            GroupMember.PutMembers(name, [username])
+        # Maintain user, from the Db since the cache only holds a copy
+        user = User.GetUser(username)
         if user:
             groups = user.groups
             groups.append(name)
@@ -221,14 +438,9 @@ class Group(_BaseModel):
             # Should not happen, but just in case, we want to know
             logging.error('Trying to remove user from non-existing group')
         else:
-            users = group.users
-            newUsers = []
-            for u in users:
-                if u != username:
-                    newUsers.append(u)
-            group.UpdateGroup(newUsers)
-        # Maintain user
-        user = Memcache.MemcacheUser().GetUser(username)
+            GroupMember.DeleteMember(name, username)
+        # Maintain user, from the Db since the cache only holds a copy
+        user = User.GetUser(username)
         if user:
             groups = user.groups
             newGroups = []
@@ -236,21 +448,121 @@ class Group(_BaseModel):
                 if g != name:
                     newGroups.append(g)
             user.UpdateUserGroups(newGroups)
-                    
-    def UpdateGroup(self, users):
-        self.users = users
-        self.put()
-        # Refresh memcache
-        Memcache.MemcacheGroup().SetGroup(self.name, self)
     
+    # Get one page of the members of a group.
+    # Returns the users and the cursor of the next page (None when done)
+    @classmethod
+    def GetUsersPage(cls, name, cursor=None, limit=GROUP_PAGE_SIZE):
+        # Keys only, the user name is part of the key name
+        query = Query("GroupMember", keys_only=True).filter('group =', name)
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(limit)
+        users = [GroupMember.UserFromKey(key) for key in keys]
+        if len(keys) < limit:
+            return users, None
+        return users, query.cursor()
+    
+    # Stream all the members of a group, one page at a time
+    @classmethod
+    def IterUsers(cls, name):
+        cursor = None
+        while True:
+            users, cursor = cls.GetUsersPage(name, cursor)
+            for user in users:
+                yield user
+            if cursor is None:
+                return
+    
+    def GetUsers(self):
+        return list(Group.IterUsers(self.name))
+    
+# GroupMember
+#    Membership of a user to a group. It is keyed by group and user name, so
+#    adding or removing a member is a single write no matter how big the
+#    group is, and adding someone twice simply overwrites the same entity.
+class GroupMember(_BaseModel):
+    group = db.StringProperty(required=True, indexed=True)
+    user = db.StringProperty(required=True, indexed=False)
+    
+    # Names are restricted to [a-zA-Z0-9_-], '|' can't be part of them
+    @staticmethod
+    def _KeyName(group, user):
+        return '%s|%s' % (group, user)
     
+    @staticmethod
+    def UserFromKey(key):
+        return str(key.name().split('|', 1)[1])
     
+    @classmethod
+    def PutMembers(cls, group, users):
+        members = [cls(key_name=cls._KeyName(group, user), group=group, user=user)
+                   for user in users]
+        for start in xrange(0, len(members), MAX_BATCH_PUT):
+            db.put(members[start:start + MAX_BATCH_PUT])
+    
+    @classmethod
+    def DeleteMember(cls, group, user):
+        db.delete(db.Key.from_path(cls.kind(), cls._KeyName(group, user)))
+
+
+
+# MailJob
+#    Checkpoint of a mail being dispatched. Once the groups are expanded,
+#    the recipients are split in fixed-size shards (MailShard, children of
+#    the job) so that each shard can be delivered by its own deferred task.
+#    A shard is only flagged done once all of its mails are written, which
+#    means that after a failure only the unfinished shards need to be resumed.
+class MailJob(_BaseModel):
+    content = db.ReferenceProperty(MailContent, required=True)
+
+    @classmethod
+    def PutJob(cls, recipients, shardSize=SEND_MAIL_SHARD_SIZE, **kwargs):
+        job = cls._Put(**kwargs)
+        shards = []
+        for index, start in enumerate(xrange(0, len(recipients), shardSize)):
+            shards.append(MailShard(parent=job, index=index,
+                                    recipients=recipients[start:start + shardSize]))
+        # As few round trips as the batch limit allows
+        for start in xrange(0, len(shards), MAX_BATCH_PUT):
+            db.put(shards[start:start + MAX_BATCH_PUT])
+        return job
+
+    def GetShards(self):
+        shards = list(Query("MailShard").ancestor(self).run())
+        # Sorted here rather than in the query to avoid a composite index
+        return sorted(shards, key=lambda shard: shard.index)
+
+    def GetUnfinishedShards(self):
+        return [shard for shard in self.GetShards() if not shard.done]
+
+    def GetContentKey(self):
+        return MailJob.content.get_value_for_datastore(self)
+
+# MailShard
+#    Slice of the recipients of a MailJob
+class MailShard(_BaseModel):
+    index = db.IntegerProperty(required=True)
+    recipients = db.StringListProperty(required=True, default=[], indexed=False)
+    done = db.BooleanProperty(required=True, default=False)
+
+    def MarkDone(self):
+        self.done = True
+        self.put()
+
+
+
 ###############################################################################
     
-MODELS = {"UdaUser" : UdaUser,
-          "User"    : User,
-          "Mail"    : Mail,
-          "Group"   : Group}
+MODELS = {"UdaUser"       : UdaUser,
+          "User"          : User,
+          "Mail"          : Mail,
+          "MailContent"   : MailContent,
+          "Group"         : Group,
+          "GroupMember"   : GroupMember,
+          "UnreadCounter" : UnreadCounter,
+          "MailJob"       : MailJob,
+          "MailShard"     : MailShard}
         
 # Wrapper on Model to avoid explicit use of db model classes
 # Kind of like a typedef... Can be handy for shortening long name or changing models
@@ -32,7 +32,9 @@ import Hashing
 import Db
 import Memcache
 from SendMail import SendMail
-import markdown
+from SendMail import ResumeStaleMail
+from Migration import MigrateAll
+from Unread import ReconcileUnread
 
 DEBUG = True
 UNIT_TEST = False
@@ -42,13 +44,17 @@ RE = re.compile(r"^[a-zA-Z0-9_-]{3,20}$")
 
 jinjaEnv = jinja2.Environment(autoescape=True,
     loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates'))) 
-jinjaEnv.filters['markdown'] = markdown.markdown
 
 # Memcache instances
 memMail = Memcache.MemcacheMail()
 memUser = Memcache.MemcacheUser()
 memUdaUser = Memcache.MemcacheUdaUser()
 memGroup = Memcache.MemcacheGroup()
+memUnread = Memcache.MemcacheUnread()
+memMarkdown = Memcache.MemcacheMarkdown()
+
+# Messages are rendered once and then served from the cache
+jinjaEnv.filters['markdown'] = memMarkdown.GetHtml
 
 class PermissionException(Exception):
     def __init__(self):
@@ -65,8 +71,15 @@ class Handler(webapp2.RequestHandler):
         t = jinjaEnv.get_template(template)
         return t.render(params)
     
+    # The page is written into the response as the template generates it,
+    # without building the whole page as a string first
     def Render(self, template, **kwargs):
-        self.Write(self.RenderStr(template, **kwargs))
+        if self.user:
+            # Shown in the header of every page
+            kwargs.setdefault('unread', memUnread.GetUnread(self.user))
+        t = jinjaEnv.get_template(template)
+        for chunk in t.generate(kwargs):
+            self.Write(chunk)
         
     def SetCookie(self, cookie):
         self.response.headers['Content-Type'] = 'text/plain'
@@ -175,12 +188,20 @@ class Group(Handler):
         
 class Inbox(Handler):
     def get(self):
-        mails = memMail.GetUserMails(self.user)
-        self.Render("inbox.html", user = self.user, admin = self.admin, mails = list(mails))
+        cursor = self.request.get("cursor")
+        try:
+            mails, next = memMail.GetInbox(self.user, cursor)
+        except ValueError:
+            self.error(400)
+            return
+        # The mails carry their summary, the contents are not read
+        self.Render("inbox.html", user = self.user, admin = self.admin,
+                    mails = mails, cursor = cursor, next = next)
         
     def post(self):
+        # Only the mail ids, not the other arguments (like the cursor)
         toDel = self.request.arguments()
-        ids = [str(id) for id in toDel]
+        ids = [str(id) for id in toDel if id.isdigit()]
         Db.Model('Mail').DeleteMails(self.user, ids)
         
         self.redirect('/inbox')
@@ -201,26 +222,25 @@ class Compose(Handler):
         message = self.request.get("message")
         kwargs = {'to':to, 'cc':cc, 'bcc':bcc, 'subject':subject, 'message':message}
         
-        if to:
-            for name in to.split(';'):
-                if not memUser.ValidUser(name) and not memGroup.ValidGroup(name):
-                    msg = "Invalid Recipient: " + name
-                    self.RenderCompose(errorTo = msg, **kwargs)
-                    return
-        else:
+        if not to:
             self.RenderCompose(errorTo = "To who?", **kwargs)
             return
-        if cc:
-            for name in cc.split(';'):
-                if not memUser.ValidUser(name) and not memGroup.ValidGroup(name):
-                    msg = "Invalid Recipient: " + name
-                    self.RenderCompose(errorCc = msg, **kwargs)
-                    return
-        if bcc:
-            for name in bcc.split(';'):
-                if not memUser.ValidUser(name) and not memGroup.ValidGroup(name):
+        recipients = [('errorTo', to), ('errorCc', cc), ('errorBcc', bcc)]
+        recipients = [(error, field.split(';')) for error, field in recipients if field]
+        # Validate all the recipients at once, users first then groups.
+        # Names that could not have been signed up are not looked up as
+        # users. Groups were never held to that rule, but names that can't
+        # be stored (i.e.: empty ones) are not looked up at all and are
+        # reported as invalid below.
+        names = set(name for error, field in recipients for name in field
+                    if Db.Model('Group').ValidName(name))
+        valid = memUser.ValidUsers(set(name for name in names if RE.match(name)))
+        valid |= memGroup.ValidGroups(names - valid)
+        for error, field in recipients:
+            for name in field:
+                if name not in valid:
                     msg = "Invalid Recipient: " + name
-                    self.RenderCompose(errorBcc = msg, **kwargs)
+                    self.RenderCompose(**dict(kwargs, **{error: msg}))
                     return
         if subject:
             if len(subject) > 500:
@@ -243,11 +263,38 @@ class Compose(Handler):
 class ViewMail(Handler):
     def get(self, id):
         mail = memMail.GetMail(id)
+        if mail is None:
+            self.error(404)
+            return
         if mail.name != self.user:
             self.error(403)   # For the sneaky ones...
             return
-        mail.SetViewed(self.user)
-        self.Render("view.html", mail=mail, user = self.user, admin = self.admin)
+        if not mail.viewed:
+            Db.Model('Mail').SetMailViewed(self.user, mail.id)
+        content = memMail.GetMailContent(mail)
+        self.Render("view.html", mail=mail, content=content,
+                    cc=content.GetCc(mail.name), user = self.user, admin = self.admin)
+    
+# Re-key the existing users and groups by name and move the messages of
+# the legacy mails to their own contents (see Migration.py)
+class Migrate(Handler):
+    def get(self):
+        if not self.admin:
+            self.error(403)
+            return
+        deferred.defer(MigrateAll)
+        self.Write("Migration started.")
+    
+# Cron job, see cron.yaml. Only reachable by admins (see app.yaml), hence
+# not a Handler as it has no user cookie.
+class ReconcileUnreadTask(webapp2.RequestHandler):
+    def get(self):
+        deferred.defer(ReconcileUnread)
+    
+# Cron job, see cron.yaml
+class ResumeMailTask(webapp2.RequestHandler):
+    def get(self):
+        deferred.defer(ResumeStaleMail)
     
 # If enabled, deploy unit tests
 if UNIT_TEST:
@@ -279,6 +326,9 @@ app = webapp2.WSGIApplication([('/', Main),
                                ('/inbox', Inbox),
                                ('/compose', Compose),
                                ('/(\d+)', ViewMail),
+                               ('/migrate', Migrate),
+                               ('/tasks/reconcile-unread', ReconcileUnreadTask),
+                               ('/tasks/resume-mail', ResumeMailTask),
                                ('%s'      % gaeunit._WEB_TEST_DIR, MainTestPageHandler),
                                ('%s/run'  % gaeunit._WEB_TEST_DIR, JsonTestRunHandler),
                                ('%s/list' % gaeunit._WEB_TEST_DIR, JsonTestListHandler)
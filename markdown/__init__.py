@@ -37,14 +37,16 @@ import re
 import codecs
 import sys
 import logging
+from timeit import default_timer as clock
 from . import util
 from .preprocessors import build_preprocessors
 from .blockprocessors import build_block_parser
 from .treeprocessors import build_treeprocessors
 from .inlinepatterns import build_inlinepatterns
-from .postprocessors import build_postprocessors
+from .postprocessors import build_postprocessors, postprocessor_runs
 from .extensions import Extension
 from .serializers import to_html_string, to_xhtml_string
+from .serializers import to_html_pieces, to_xhtml_pieces
 
 __all__ = ['Markdown', 'markdown', 'markdownFromFile']
 
@@ -73,6 +75,13 @@ class Markdown(object):
         'xhtml5': to_xhtml_string,
     }
 
+    # Serializers of the top-level elements of the document, one at a time
+    # (see convertStream)
+    piece_serializers = {
+        to_html_string : to_html_pieces,
+        to_xhtml_string: to_xhtml_pieces,
+    }
+
     ESCAPED_CHARS = ['\\', '`', '*', '_', '{', '}', '[', ']',
                     '(', ')', '>', '#', '+', '-', '.', '!']
 
@@ -103,6 +112,9 @@ class Markdown(object):
         * enable_attributes: Enable the conversion of attributes. Default: True
         * smart_emphasis: Treat `_connected_words_` intelegently Default: True
         * lazy_ol: Ignore number of first item of ordered lists. Default: True
+        * instrument: Function called with the time taken by each processor
+           and inline pattern of a conversion. Default: None (see
+           `instrumented`).
 
         """
 
@@ -121,6 +133,8 @@ class Markdown(object):
         for option, default in self.option_defaults.items():
             setattr(self, option, kwargs.get(option, default))
 
+        self.instrument = kwargs.get('instrument')
+
         self.safeMode = kwargs.get('safe_mode', False)
         if self.safeMode and 'enable_attributes' not in kwargs:
             # Disable attributes in safeMode when not explicitly set
@@ -276,6 +290,46 @@ class Markdown(object):
         if not source.strip():
             return ''  # a blank unicode string
 
+        root = self.build_tree(source)
+
+        # Serialize _properly_.  Strip top-level tags.
+        if self.instrument:
+            began, size = clock(), tree_size(root)
+        output = self.serializer(root)
+        if self.stripTopLevelTags:
+            try:
+                start = output.index('<%s>'%self.doc_tag)+len(self.doc_tag)+2
+                end = output.rindex('</%s>'%self.doc_tag)
+                output = output[start:end].strip()
+            except ValueError:
+                if output.strip().endswith('<%s />'%self.doc_tag):
+                    # We have an empty document
+                    output = ''
+                else:
+                    # We have a serious problem
+                    raise ValueError('Markdown failed to strip top-level tags. Document=%r' % output.strip())
+        if self.instrument:
+            self.instrument('serializer', self.output_format, clock() - began,
+                            size, len(output))
+
+        # Run the text post-processors
+        runs = postprocessor_runs(self.postprocessors)
+        if self.instrument:
+            output = self.instrumented('postprocessor', runs, output, len,
+                                       lambda run, text: run(text))
+        else:
+            for name, run in runs:
+                output = run(output)
+
+        return output.strip()
+
+    def build_tree(self, source):
+        """
+        Run the first three steps of `convert` on a non blank source.
+
+        Returns: the ElementTree root of the document.
+
+        """
         try:
             source = util.text_type(source)
         except UnicodeDecodeError as e:
@@ -283,40 +337,141 @@ class Markdown(object):
             e.reason += '. -- Note: Markdown only accepts unicode input!'
             raise
 
+        if self.instrument:
+            return self.build_tree_instrumented(source)
+
         # Split into lines and run the line preprocessors.
         self.lines = source.split("\n")
-        for prep in self.preprocessors.values():
+        for prep in self.preprocessors.ordered_values():
             self.lines = prep.run(self.lines)
 
         # Parse the high-level elements.
         root = self.parser.parseDocument(self.lines).getroot()
 
         # Run the tree-processors
-        for treeprocessor in self.treeprocessors.values():
+        for treeprocessor in self.treeprocessors.ordered_values():
             newRoot = treeprocessor.run(root)
             if newRoot:
                 root = newRoot
+        return root
 
-        # Serialize _properly_.  Strip top-level tags.
-        output = self.serializer(root)
-        if self.stripTopLevelTags:
-            try:
-                start = output.index('<%s>'%self.doc_tag)+len(self.doc_tag)+2
-                end = output.rindex('</%s>'%self.doc_tag)
-                output = output[start:end].strip()
-            except ValueError:
-                if output.strip().endswith('<%s />'%self.doc_tag):
-                    # We have an empty document
-                    output = ''
-                else:
-                    # We have a serious problem
-                    raise ValueError('Markdown failed to strip top-level tags. Document=%r' % output.strip())
+    def build_tree_instrumented(self, source):
+        """ `build_tree`, passing the time of each step to `instrument`. """
+        self.lines = self.instrumented('preprocessor',
+                                       self.preprocessors.items(),
+                                       source.split("\n"), lines_size,
+                                       lambda prep, lines: prep.run(lines))
 
-        # Run the text post-processors
-        for pp in self.postprocessors.values():
-            output = pp.run(output)
+        start = clock()
+        root = self.parser.parseDocument(self.lines).getroot()
+        self.instrument('parser', 'parser', clock() - start,
+                        lines_size(self.lines), tree_size(root))
+
+        # A tree-processor may return a new root, or None (or an element
+        # without children) to keep the current one
+        return self.instrumented('treeprocessor', self.treeprocessors.items(),
+                                 root,
+                                 tree_size,
+                                 lambda treeprocessor, root:
+                                     treeprocessor.run(root) or root)
+
+    def instrumented(self, stage, processors, data, size, run):
+        """
+        Run processors on data, passing the time each one takes to
+        `instrument`.
+
+        The `instrument` option of Markdown is a function called as
+
+            instrument(stage, name, time, before, after, attempts, hits)
+
+        once for each processor and inline pattern of a conversion, once it
+        is over. `stage` is the kind of processor ("preprocessor", "parser",
+        "blockprocessor", "treeprocessor", "inlinepattern", "serializer" or
+        "postprocessor") and `name` its name in the registry (postprocessors
+        run as one have their names joined by "+", see
+        `postprocessors.postprocessor_runs`). `time` is the wall time in
+        seconds. `before` and `after` are the sizes of the data it was given
+        and of the one it returned: chars of text, or elements of a tree.
+        They are None for the block processors. The time of the
+        parser includes the block processors, the one of the inline
+        treeprocessor the inline patterns. The time of a block processor or
+        an inline pattern leaves out the ones applied within what it matched.
+        `attempts` and `hits` are only given for those: how many times they
+        were tried and matched (block processor tests and runs, pattern regex
+        match or search calls and nodes).
 
-        return output.strip()
+        Keyword arguments:
+
+        * stage: The kind of the processors.
+        * processors: The (name, processor) pairs, in order.
+        * data: What the first processor is run on.
+        * size: Function giving the size of data.
+        * run: Function running a processor on data, returns the new data.
+
+        Returns: the data returned by the last processor.
+
+        """
+        for name, processor in processors:
+            before = size(data)
+            start = clock()
+            data = run(processor, data)
+            self.instrument(stage, name, clock() - start, before, size(data))
+        return data
+
+    def convertStream(self, source, write):
+        """
+        Convert markdown like `convert`, passing the HTML to `write` a piece
+        at a time instead of returning it.
+
+        The top-level elements of the document are serialized one by one and
+        each goes through the postprocessors on its own, so that the HTML of
+        the whole document is never held in memory. This requires every
+        postprocessor to accept pieces (see `Postprocessor.stream_safe`) and
+        the top-level tags to be stripped, and the conversion not to be
+        instrumented; otherwise the document is converted by `convert` and
+        written at once.
+
+        Keyword arguments:
+
+        * source: Source text as a Unicode string.
+        * write: Function called with each piece of HTML, in order.
+
+        """
+        serializer = self.piece_serializers.get(self.serializer)
+        postprocessors = self.postprocessors.ordered_values()
+        runs = postprocessor_runs(self.postprocessors)
+        if serializer is None or not self.stripTopLevelTags or \
+                self.instrument or \
+                not all(pp.stream_safe for pp in postprocessors):
+            output = self.convert(source)
+            if output:
+                write(output)
+            return self
+
+        if not source.strip():
+            return self
+
+        # Leading whitespace is dropped and trailing whitespace held back
+        # until more HTML follows, as convert strips the document
+        started = False
+        pending = ''
+        for output in serializer(self.build_tree(source)):
+            for name, run in runs:
+                output = run(output)
+            if not started:
+                output = output.lstrip()
+                if not output:
+                    continue
+                started = True
+            stripped = output.rstrip()
+            if stripped:
+                if pending:
+                    write(pending)
+                write(stripped)
+                pending = output[len(stripped):]
+            else:
+                pending += output
+        return self
 
     def convertFile(self, input=None, output=None, encoding=None):
         """Converts a markdown file and returns the HTML as a unicode string.
@@ -385,6 +540,20 @@ class Markdown(object):
         return self
 
 
+def lines_size(lines):
+    """ Chars of text in a list of lines. """
+    return sum(len(line) + 1 for line in lines) - 1 if lines else 0
+
+
+def tree_size(root):
+    """ Elements of a tree. """
+    try:
+        iterate = root.iter
+    except AttributeError:
+        iterate = root.getiterator # cET compatibility
+    return sum(1 for elem in iterate())
+
+
 """
 EXPORTED FUNCTIONS
 =============================================================================
@@ -18,7 +18,8 @@ def parse_options():
     Define and parse `optparse` options for command-line usage.
     """
     usage = """%prog [options] [INPUTFILE]
-       (STDIN is assumed if no INPUTFILE is given)"""
+       (STDIN is assumed if no INPUTFILE is given)
+       %prog [options] -b OUTPUT_DIR [-m MANIFEST] [INPUTFILE ...]"""
     desc = "A Python implementation of John Gruber's Markdown. " \
            "http://packages.python.org/Markdown/"
     ver = "%%prog %s" % markdown.version
@@ -49,6 +50,22 @@ def parse_options():
     parser.add_option("-n", "--no_lazy_ol", dest="lazy_ol", 
                       action='store_false', default=True,
                       help="Observe number of first item of ordered lists.")
+    parser.add_option("-b", "--batch", dest="batch", default=None,
+                      metavar="OUTPUT_DIR",
+                      help="Convert all the INPUTFILEs on a process pool into "
+                           "a mirrored tree of html files in OUTPUT_DIR, "
+                           "skipping the ones unchanged since the last run.")
+    parser.add_option("-m", "--manifest", dest="manifest", default=None,
+                      metavar="MANIFEST",
+                      help="Batch mode: also convert the files listed in "
+                           "MANIFEST, one per line.")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                      help="Batch mode: number of processes. Defaults to "
+                           "the number of CPUs.")
+    parser.add_option("-r", "--root", dest="root", default=None,
+                      metavar="ROOT",
+                      help="Batch mode: directory mirrored in OUTPUT_DIR. "
+                           "Defaults to the deepest one holding all inputs.")
 
     (options, args) = parser.parse_args()
 
@@ -60,13 +77,22 @@ def parse_options():
     if not options.extensions:
         options.extensions = []
 
+    batch = None
+    if options.batch:
+        batch = {'inputs': args,
+                 'manifest': options.manifest,
+                 'output_dir': options.batch,
+                 'processes': options.jobs,
+                 'root': options.root}
+
     return {'input': input_file,
             'output': options.filename,
             'safe_mode': options.safe,
             'extensions': options.extensions,
             'encoding': options.encoding,
             'output_format': options.output_format,
-            'lazy_ol': options.lazy_ol}, options.verbose
+            'lazy_ol': options.lazy_ol,
+            'batch': batch}, options.verbose
 
 def run():
     """Run Markdown from the command line."""
@@ -78,7 +104,50 @@ def run():
     logger.addHandler(logging.StreamHandler())
 
     # Run
-    markdown.markdownFromFile(**options)
+    batch = options.pop('batch')
+    if batch:
+        run_batch(batch, options, logging_level < CRITICAL + 10)
+    else:
+        markdown.markdownFromFile(**options)
+
+def run_batch(batch, options, report):
+    """Convert many files from the command line (see markdown.batch)."""
+    from markdown.batch import markdownFromFiles, read_manifest
+
+    inputs = list(batch['inputs'])
+    if batch['manifest']:
+        inputs.extend(read_manifest(batch['manifest']))
+
+    # Reported twice a second at most
+    last = [None]
+    def progress(done, total, skipped, failed, chars, elapsed):
+        if done < total and last[0] is not None and elapsed - last[0] < 0.5:
+            return
+        last[0] = elapsed
+        converted = done - skipped - failed
+        sys.stderr.write("\r%d/%d files (%d skipped, %d failed), "
+                         "%.1f files/s, %.1f kchars/s " %
+                         (done, total, skipped, failed,
+                          converted / elapsed if elapsed else 0,
+                          chars / elapsed / 1e3 if elapsed else 0))
+        if done == total:
+            sys.stderr.write("\n")
+
+    options = dict((key, value) for key, value in options.items()
+                   if key not in ('input', 'output'))
+    try:
+        summary = markdownFromFiles(inputs, batch['output_dir'],
+                                    root=batch['root'],
+                                    processes=batch['processes'],
+                                    progress=progress if report else None,
+                                    **options)
+    except ValueError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    for path, error in summary['failed']:
+        sys.stderr.write("Failed to convert %s: %s\n" % (path, error))
+    if summary['failed']:
+        sys.exit(1)
 
 if __name__ == '__main__':
     # Support running module as a commandline command. 
@@ -0,0 +1,204 @@
+"""
+BATCH CONVERSION
+=============================================================================
+
+Convert many markdown files at once, on a pool of processes, into a tree of
+html files mirroring the tree of the sources:
+
+    from markdown.batch import markdownFromFiles
+    markdownFromFiles(['docs/a.txt', 'docs/b/c.txt'], 'html')
+
+writes `html/a.html` and `html/b/c.html`. Each process converts its share of
+the files with a single Markdown instance.
+
+The hash of every source converted (along with the version of Markdown and
+its options) is kept in the output directory, so that the files that did not
+change since the last run are skipped.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from . import Markdown, version
+import codecs
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+# Hashes of the sources of the previous runs, in the output directory
+STATE_FILE = '.markdown-batch.json'
+
+# State of a worker process
+_worker = {}
+
+
+def read_manifest(manifest):
+    """
+    Return the paths listed in a manifest file, one per line, relative to
+    the directory of the manifest. Blank lines and lines starting with "#"
+    are ignored.
+
+    """
+    base = os.path.dirname(manifest)
+    paths = []
+    with codecs.open(manifest, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                paths.append(os.path.join(base, line))
+    return paths
+
+
+def common_dir(paths):
+    """ Deepest directory holding all the paths. """
+    dirs = [os.path.dirname(os.path.abspath(path)).split(os.sep)
+            for path in paths]
+    common = dirs[0]
+    for parts in dirs[1:]:
+        length = 0
+        for a, b in zip(common, parts):
+            if a != b:
+                break
+            length += 1
+        common = common[:length]
+    return os.sep.join(common) or os.sep
+
+
+def _init_worker(kwargs, encoding):
+    """ Build the Markdown instance of a worker. """
+    _worker['md'] = Markdown(**kwargs)
+    _worker['encoding'] = encoding
+    # Anything changing the html of a source changes its hash
+    _worker['fingerprint'] = repr((version, encoding,
+                                   sorted(kwargs.items()))).encode('utf-8')
+
+
+def _convert(task):
+    """
+    Convert a source file, unless it has the hash it had in the previous
+    run and its html is still there.
+
+    Returns: the source, its hash, the chars converted (None if skipped)
+    and the error, if any.
+
+    """
+    source, output, previous = task
+    try:
+        with open(source, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(_worker['fingerprint'] + data).hexdigest()
+        if digest == previous and os.path.exists(output):
+            return source, digest, None, None
+        text = data.decode(_worker['encoding']).lstrip('\ufeff')
+        html = _worker['md'].reset().convert(text)
+        directory = os.path.dirname(output)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another worker in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        with codecs.open(output, 'w', encoding=_worker['encoding'],
+                         errors='xmlcharrefreplace') as f:
+            f.write(html)
+        return source, digest, len(text), None
+    except Exception as e:
+        return source, None, None, '%s: %s' % (type(e).__name__, e)
+
+
+def markdownFromFiles(inputs, output_dir, root=None, processes=None,
+                      encoding=None, progress=None, **kwargs):
+    """Convert markdown files into a mirrored tree of html files.
+
+    Keyword arguments:
+
+    * inputs: List of the paths of the markdown files.
+    * output_dir: Directory of the html files.
+    * root: Directory whose tree is mirrored in output_dir. Defaults to the
+      deepest directory holding all the inputs.
+    * processes: Size of the process pool. Defaults to the number of CPUs,
+      1 converts in this process.
+    * encoding: Encoding of input and output files. Defaults to utf-8.
+    * progress: Function called after each file as
+      `progress(done, total, skipped, failed, chars, elapsed)`, with the
+      number of files skipped and failed so far, the chars converted so far
+      and the seconds elapsed.
+    * Any arguments accepted by the Markdown class. They are passed to the
+      processes, so they must be picklable (extensions given by name).
+
+    Returns: a dict with the number of files "converted" and "skipped", and
+    the list of the (path, error) of the ones that "failed".
+
+    An input given more than once is converted once. Raises ValueError if
+    two inputs would be written to the same html file (i.e.: a.txt and
+    a.md), or if an input is not within root.
+
+    """
+    encoding = encoding or "utf-8"
+    if not inputs:
+        return {'converted': 0, 'skipped': 0, 'failed': []}
+    root = os.path.abspath(root or common_dir(inputs))
+
+    state_path = os.path.join(output_dir, STATE_FILE)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+
+    tasks, names, sources, outputs = [], {}, set(), {}
+    for source in inputs:
+        path = os.path.normcase(os.path.abspath(source))
+        if path in sources:
+            continue
+        sources.add(path)
+        name = os.path.relpath(os.path.abspath(source), root)
+        if name.split(os.sep)[0] == os.pardir:
+            raise ValueError('%s is not within %s' % (source, root))
+        output = os.path.join(output_dir, os.path.splitext(name)[0] + '.html')
+        key = os.path.normcase(output)
+        if key in outputs:
+            raise ValueError('%s and %s would both be written to %s' %
+                             (outputs[key], source, output))
+        outputs[key] = source
+        names[source] = name
+        tasks.append((source, output, state.get(name)))
+
+    summary = {'converted': 0, 'skipped': 0, 'failed': []}
+    chars = 0
+    start = time.time()
+    if processes == 1:
+        _init_worker(kwargs, encoding)
+        pool = None
+        results = (_convert(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (kwargs, encoding))
+        results = pool.imap_unordered(_convert, tasks,
+                                      chunksize=max(1, len(tasks) // 256))
+    try:
+        for done, (source, digest, size, error) in enumerate(results, 1):
+            name = names[source]
+            if error is not None:
+                summary['failed'].append((source, error))
+                state.pop(name, None)
+            elif size is None:
+                summary['skipped'] += 1
+            else:
+                summary['converted'] += 1
+                chars += size
+                state[name] = digest
+            if progress:
+                progress(done, len(tasks), summary['skipped'],
+                         len(summary['failed']), chars, time.time() - start)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        # Keep what was converted, even when interrupted
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        with open(state_path, 'w') as f:
+            json.dump(state, f, indent=0, sort_keys=True)
+    return summary
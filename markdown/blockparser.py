@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from . import util
 from . import odict
+from timeit import default_timer as clock
 
 class State(list):
     """ Track the current and nested state of the parser. 
@@ -47,6 +48,9 @@ class BlockParser:
         self.blockprocessors = odict.OrderedDict()
         self.state = State()
         self.markdown = markdown
+        # Time, tests and runs of each processor while an instrumented
+        # document is parsed (see Markdown.instrumented)
+        self.stats = None
 
     def parseDocument(self, lines):
         """ Parse a markdown document into an ElementTree. 
@@ -58,9 +62,19 @@ class BlockParser:
         This should only be called on an entire document, not pieces.
 
         """
+        instrument = self.markdown.instrument
+        if instrument:
+            self.stats = [[0, 0, 0] for processor in self.blockprocessors]
+            self.inner = 0
         # Create a ElementTree from the lines
         self.root = util.etree.Element(self.markdown.doc_tag)
         self.parseChunk(self.root, '\n'.join(lines))
+        if instrument:
+            for name, (time, tests, runs) in zip(self.blockprocessors.keys(),
+                                                 self.stats):
+                instrument('blockprocessor', name, time, None, None,
+                           tests, runs)
+            self.stats = None
         return util.etree.ElementTree(self.root)
 
     def parseChunk(self, parent, text):
@@ -89,11 +103,35 @@ class BlockParser:
         block.
 
         """
+        if self.stats is not None:
+            return self.parseBlocksInstrumented(parent, blocks)
         while blocks:
-            for processor in self.blockprocessors.values():
+            for processor in self.blockprocessors.ordered_values():
                 if processor.test(parent, blocks[0]):
                     if processor.run(parent, blocks) is not False:
                         # run returns True or None
                         break
 
+    def parseBlocksInstrumented(self, parent, blocks):
+        """
+        `parseBlocks`, adding the time of each blockprocessor to its stats.
+
+        The time spent parsing the blocks nested in the block of a processor
+        goes to the processors of those blocks rather than to that one.
+        """
+        processors = self.blockprocessors.ordered_values()
+        while blocks:
+            for processor, stats in zip(processors, self.stats):
+                start, inner = clock(), self.inner
+                stats[1] += 1
+                handled = processor.test(parent, blocks[0]) and \
+                          processor.run(parent, blocks) is not False
+                if handled:
+                    stats[2] += 1
+                elapsed = clock() - start
+                stats[0] += elapsed - (self.inner - inner)
+                self.inner = inner + elapsed
+                if handled:
+                    break
+
 
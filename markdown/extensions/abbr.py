@@ -39,7 +39,19 @@ class AbbrExtension(Extension):
 
     def extendMarkdown(self, md, md_globals):
         """ Insert AbbrPreprocessor before ReferencePreprocessor. """
+        self.md = md
+        md.registerExtension(self)
         md.preprocessors.add('abbr', AbbrPreprocessor(md), '<reference')
+
+    def reset(self):
+        """
+        Remove the patterns of the abbreviations defined by the previous
+        document, so that they don't apply to the next one.
+
+        """
+        for key in list(self.md.inlinePatterns.keys()):
+            if key.startswith('abbr-'):
+                del self.md.inlinePatterns[key]
         
            
 class AbbrPreprocessor(Preprocessor):
@@ -300,6 +300,9 @@ class FootnoteTreeprocessor(Treeprocessor):
 
 class FootnotePostprocessor(Postprocessor):
     """ Replace placeholders with html entities. """
+
+    stream_safe = True
+
     def __init__(self, footnotes):
         self.footnotes = footnotes
 
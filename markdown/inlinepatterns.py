@@ -46,6 +46,9 @@ from __future__ import unicode_literals
 from . import util
 from . import odict
 import re
+import sre_compile
+import sre_constants
+import sre_parse
 try:
     from urllib.parse import urlparse, urlunparse
 except ImportError:
@@ -138,6 +141,201 @@ def handleAttributes(text, parent):
     return ATTR_RE.sub(attributeCallback, text)
 
 
+"""
+The compiled regular expressions
+-----------------------------------------------------------------------------
+"""
+
+# Compiled expressions shared by all the patterns, keyed by their template,
+# the source of the pattern and the flags. The `re` module only caches a
+# limited number of expressions and drops them all once full, so every new
+# Markdown instance could otherwise end up recompiling each of its inline
+# patterns. Some extensions (i.e.: abbr) build patterns out of the document,
+# so the registry is dropped the same way once it holds _MAX_COMPILED ones.
+_compiled_patterns = {}
+_MAX_COMPILED = 500
+
+PATTERN_TEMPLATE = "^(.*?)%s(.*?)$"
+SCANNER_TEMPLATE = "()%s()"
+
+def _compile(template, pattern, flags):
+    key = (template, pattern, flags)
+    compiled = _compiled_patterns.get(key)
+    if compiled is None:
+        if len(_compiled_patterns) >= _MAX_COMPILED:
+            _compiled_patterns.clear()
+        if template is SCANNER_TEMPLATE:
+            compiled = Scanner(pattern, flags)
+        else:
+            compiled = re.compile(template % pattern, flags)
+        # Another thread may have compiled it in the meantime
+        compiled = _compiled_patterns.setdefault(key, compiled)
+    return compiled
+
+def compile_pattern(pattern, flags=re.DOTALL | re.UNICODE):
+    """
+    Return the compiled regular expression of an inline pattern, wrapped so
+    that it captures the whole block. It is compiled once per process and
+    shared by all the Markdown instances and extensions.
+
+    """
+    return _compile(PATTERN_TEMPLATE, pattern, flags)
+
+def compile_scanner(pattern, flags=re.DOTALL | re.UNICODE):
+    """
+    Return the `Scanner` of an inline pattern, or None if the pattern can
+    not be applied in a single pass. It is shared as the compiled patterns.
+
+    """
+    scanner = _compile(SCANNER_TEMPLATE, pattern, flags)
+    if scanner.triggers is None:
+        return None
+    return scanner
+
+
+class Scanner(object):
+    """
+    What the InlineProcessor needs to apply a pattern in a single pass over
+    a text rather than matching the whole text again after each replacement.
+
+    * regex: the pattern, matched where it starts. Its groups are numbered
+      as the ones of `compile_pattern`, but the first and the last ones are
+      always empty, so that a match never reads the text around the pattern.
+    * triggers: an expression finding the characters a match may start
+      with, or None if the pattern may start anywhere.
+    * reach: how many characters past its start an attempt to match may
+      read, or None if it is unbounded.
+    * prefix: when the reach is unbounded, the beginning of the pattern that
+      has a bounded one (or None), matched where the pattern starts. An
+      attempt where it does not match reads at most `prefix_reach`
+      characters.
+
+    All of it is derived from the parse tree of the pattern, as built by
+    `sre_parse` and compiled back by `sre_compile`. Those are internals of
+    the `re` module, not a public API. A construct not handled here makes
+    the pattern fall back to `getCompiledRegExp`, but a change of the
+    layout of the ones handled would go unnoticed: test/test_Markdown.py
+    checks the output against the stored html of a corpus.
+
+    """
+
+    def __init__(self, pattern, flags):
+        self.regex = re.compile(SCANNER_TEMPLATE % pattern, flags)
+        self.triggers = None
+        self.reach = None
+        self.prefix = None
+        self.prefix_reach = None
+        if flags & re.IGNORECASE:
+            return
+        items = sre_parse.parse(pattern, flags)
+        chars, empty = _first_chars(items)
+        if not chars or empty:
+            return
+        self.triggers = re.compile("[%s]" % "".join(
+                "\\x%02x" % ord(c) if ord(c) < 0x100 else
+                "\\u%04x" % ord(c) for c in sorted(chars)), flags)
+        self.reach = _measure(items)[1]
+        if self.reach is None:
+            for length in range(len(items), 0, -1):
+                reach = _measure(items[:length])[1]
+                if reach is not None:
+                    break
+            if reach:
+                self.prefix = sre_compile.compile(items[:length], flags)
+                self.prefix_reach = reach
+
+
+def _first_chars(items):
+    """
+    Return the characters a match of the parsed expression may start with,
+    or None if it may start with any, and whether the match may be empty.
+
+    """
+    chars = set()
+    for op, av in items:
+        if op in (sre_constants.AT, sre_constants.ASSERT,
+                  sre_constants.ASSERT_NOT):
+            # Zero-width
+            continue
+        elif op == sre_constants.LITERAL:
+            found, empty = set([util.int2str(av)]), False
+        elif op == sre_constants.IN:
+            found, empty = _class_chars(av), False
+        elif op == sre_constants.SUBPATTERN:
+            found, empty = _first_chars(av[-1])
+        elif op == sre_constants.BRANCH:
+            found, empty = set(), False
+            for branch in av[1]:
+                more, maybe = _first_chars(branch)
+                if more is None:
+                    return None, False
+                found |= more
+                empty = empty or maybe
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            found, empty = _first_chars(av[2])
+            empty = empty or av[0] == 0
+        else:
+            return None, False
+        if found is None:
+            return None, False
+        chars |= found
+        if not empty:
+            return chars, False
+    return chars, True
+
+def _class_chars(items):
+    """ Return the characters of a parsed class, or None if too many. """
+    chars = set()
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            chars.add(util.int2str(av))
+        elif op == sre_constants.RANGE and av[1] - av[0] < 0x100:
+            chars.update(util.int2str(c) for c in range(av[0], av[1] + 1))
+        else:
+            return None
+    return chars
+
+def _measure(items):
+    """
+    Return the maximum width of a match of the parsed expression and how far
+    past its start an attempt to match may read (None when unbounded).
+
+    """
+    width = reach = 0
+    for op, av in items:
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if av[0] < 0:
+                # A lookbehind only reads the text before
+                continue
+            size, far = 0, _measure(av[1])[1]
+        elif op == sre_constants.AT:
+            size, far = 0, 1
+        elif op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+                    sre_constants.ANY, sre_constants.IN):
+            size, far = 1, 1
+        elif op == sre_constants.SUBPATTERN:
+            size, far = _measure(av[-1])
+        elif op == sre_constants.BRANCH:
+            size = far = 0
+            for branch in av[1]:
+                more, further = _measure(branch)
+                if further is None:
+                    return None, None
+                size, far = max(size, more), max(far, further)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if av[1] == sre_constants.MAXREPEAT:
+                return None, None
+            size, far = _measure(av[2])
+            if far is not None:
+                size, far = size * av[1], size * (av[1] - 1) + far
+        else:
+            return None, None
+        if far is None:
+            return None, None
+        width, reach = width + size, max(reach, width + far)
+    return width, reach
+
+
 """
 The pattern classes
 -----------------------------------------------------------------------------
@@ -156,8 +354,7 @@ class Pattern(object):
 
         """
         self.pattern = pattern
-        self.compiled_re = re.compile("^(.*?)%s(.*?)$" % pattern, 
-                                      re.DOTALL | re.UNICODE)
+        self.compiled_re = compile_pattern(pattern)
 
         # Api for Markdown to pass safe_mode into instance
         self.safe_mode = False
@@ -168,6 +365,20 @@ class Pattern(object):
         """ Return a compiled regular expression. """
         return self.compiled_re
 
+    def getScanner(self):
+        """
+        Return the `Scanner` used by the InlineProcessor to apply the
+        pattern in a single pass over a text, or None if the pattern does
+        not use the default wrapping of its regular expression or may start
+        anywhere, in which case it is applied with `getCompiledRegExp`.
+
+        """
+        pattern = getattr(self, 'pattern', None)
+        compiled = self.getCompiledRegExp()
+        if pattern is None or compiled.pattern != PATTERN_TEMPLATE % pattern:
+            return None
+        return compile_scanner(pattern, compiled.flags)
+
     def handleMatch(self, m):
         """Return a ElementTree element from the given match.
 
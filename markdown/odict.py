@@ -15,10 +15,17 @@ class OrderedDict(dict):
     
     Copied from Django's SortedDict with some modifications.
 
+    The values in order and the index of each key are computed once and
+    kept until the dictionary changes, so that the processors can be
+    iterated as a plain tuple. `keyOrder` must only be changed through the
+    methods of the dictionary.
+
     """
     def __new__(cls, *args, **kwargs):
         instance = super(OrderedDict, cls).__new__(cls, *args, **kwargs)
         instance.keyOrder = []
+        instance._frozen = None
+        instance._positions = None
         return instance
 
     def __init__(self, data=None):
@@ -26,6 +33,7 @@ class OrderedDict(dict):
             data = data or []
             super(OrderedDict, self).__init__(data)
             self.keyOrder = list(data) if data else []
+            self._changed()
         else:
             super(OrderedDict, self).__init__()
             super_set = super(OrderedDict, self).__setitem__
@@ -35,6 +43,12 @@ class OrderedDict(dict):
                     self.keyOrder.append(key)
                 # But override with last value in data (dict() does this)
                 super_set(key, value)
+            self._changed()
+
+    def _changed(self):
+        """ Drop what is computed from the order and the values. """
+        self._frozen = None
+        self._positions = None
 
     def __deepcopy__(self, memo):
         return self.__class__([(key, deepcopy(value, memo))
@@ -50,10 +64,12 @@ class OrderedDict(dict):
         if key not in self:
             self.keyOrder.append(key)
         super(OrderedDict, self).__setitem__(key, value)
+        self._changed()
 
     def __delitem__(self, key):
         super(OrderedDict, self).__delitem__(key)
         self.keyOrder.remove(key)
+        self._changed()
 
     def __iter__(self):
         return iter(self.keyOrder)
@@ -68,11 +84,13 @@ class OrderedDict(dict):
         except ValueError:
             # Key wasn't in the dictionary in the first place. No problem.
             pass
+        self._changed()
         return result
 
     def popitem(self):
         result = super(OrderedDict, self).popitem()
         self.keyOrder.remove(result[0])
+        self._changed()
         return result
 
     def _iteritems(self):
@@ -103,7 +121,7 @@ class OrderedDict(dict):
             return self.keyOrder[:]
 
         def values(self):
-            return [self[k] for k in self.keyOrder]
+            return list(self.ordered_values())
 
     def update(self, dict_):
         for k, v in iteritems_compat(dict_):
@@ -112,11 +130,18 @@ class OrderedDict(dict):
     def setdefault(self, key, default):
         if key not in self:
             self.keyOrder.append(key)
+            self._changed()
         return super(OrderedDict, self).setdefault(key, default)
 
+    def ordered_values(self):
+        """Returns the values in order, as a tuple kept until a change."""
+        if self._frozen is None:
+            self._frozen = tuple(self[k] for k in self.keyOrder)
+        return self._frozen
+
     def value_for_index(self, index):
         """Returns the value of the item at the given zero-based index."""
-        return self[self.keyOrder[index]]
+        return self.ordered_values()[index]
 
     def insert(self, index, key, value):
         """Inserts the key, value pair before the item with the given index."""
@@ -127,6 +152,7 @@ class OrderedDict(dict):
                 index -= 1
         self.keyOrder.insert(index, key)
         super(OrderedDict, self).__setitem__(key, value)
+        self._changed()
 
     def copy(self):
         """Returns a copy of this object."""
@@ -143,12 +169,15 @@ class OrderedDict(dict):
     def clear(self):
         super(OrderedDict, self).clear()
         self.keyOrder = []
+        self._changed()
 
     def index(self, key):
         """ Return the index of a given key. """
+        if self._positions is None:
+            self._positions = dict((k, i) for i, k in enumerate(self.keyOrder))
         try:
-            return self.keyOrder.index(key)
-        except ValueError:
+            return self._positions[key]
+        except KeyError:
             raise ValueError("Element '%s' was not found in OrderedDict" % key)
 
     def index_for_location(self, location):
@@ -180,8 +209,9 @@ class OrderedDict(dict):
 
     def link(self, key, location):
         """ Change location of an existing item. """
-        n = self.keyOrder.index(key)
+        n = self.index(key)
         del self.keyOrder[n]
+        self._changed()
         try:
             i = self.index_for_location(location)
             if i is not None:
@@ -192,3 +222,5 @@ class OrderedDict(dict):
             # restore to prevent data loss and reraise
             self.keyOrder.insert(n, key)
             raise e
+        finally:
+            self._changed()
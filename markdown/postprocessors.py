@@ -12,6 +12,7 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from . import util
 from . import odict
+import heapq
 import re
 
 
@@ -24,6 +25,30 @@ def build_postprocessors(md_instance, **kwargs):
     return postprocessors
 
 
+def postprocessor_runs(postprocessors):
+    """
+    Return the postprocessors of an OrderedDict as (name, run) pairs, in the
+    order they are run, `run` taking and returning the text.
+
+    When the default "raw_html", "amp_substitute" and "unescape"
+    postprocessors directly follow each other, they are a single run of
+    `RawHtmlPostprocessor.run_fused`.
+
+    """
+    names = list(postprocessors.keys())
+    processors = postprocessors.ordered_values()
+    runs = []
+    i = 0
+    while i < len(processors):
+        if [type(pp) for pp in processors[i:i + 3]] == FUSED_TYPES:
+            runs.append(("+".join(names[i:i + 3]), processors[i].run_fused))
+            i += 3
+        else:
+            runs.append((names[i], processors[i].run))
+            i += 1
+    return runs
+
+
 class Postprocessor(util.Processor):
     """
     Postprocessors are run after the ElementTree it converted back into text.
@@ -33,8 +58,15 @@ class Postprocessor(util.Processor):
 
     Postprocessors must extend markdown.Postprocessor.
 
+    Those that only replace what is found within the text or the attributes
+    of an element can set `stream_safe` to True: Markdown.convertStream then
+    runs them on each top-level element of the document, in order, instead
+    of the whole document.
+
     """
 
+    stream_safe = False
+
     def run(self, text):
         """
         Subclasses of Postprocessor should implement a `run` method, which
@@ -48,10 +80,35 @@ class Postprocessor(util.Processor):
 class RawHtmlPostprocessor(Postprocessor):
     """ Restore raw html to the document. """
 
+    stream_safe = True
+
+    RE = re.compile(util.STX + 'wzxhzdk:(0|[1-9][0-9]*)' + util.ETX)
+    # Entities and escaped chars (see AndSubstitutePostprocessor and
+    # UnescapePostprocessor)
+    UNESCAPE_RE = re.compile('%s(?:amp|(\d+))%s' % (util.STX, util.ETX))
+
     def run(self, text):
-        """ Iterate over html stash and restore "safe" html. """
-        for i in range(self.markdown.htmlStash.html_counter):
-            html, safe  = self.markdown.htmlStash.rawHtmlBlocks[i]
+        """
+        Iterate over html stash and restore "safe" html.
+
+        The text is split at the placeholders in a single scan, so that each
+        block is put in place without searching the whole text for it. The
+        blocks are still restored in the order of the stash: a paragraph
+        wrapping a placeholder may only appear once the blocks before it
+        are in place.
+
+        """
+        stash = self.markdown.htmlStash
+        # The pieces of the text as a linked list. Placeholders get a piece
+        # of their own, found by their index in the stash. The indexes found
+        # are kept in a heap, the text may only hold a few of them when it
+        # is a piece of the document.
+        self.pieces, self.prev, self.next = [], [], []
+        self.found, self.indexes = {}, []
+        self.insert(None, text, 0)
+        while self.indexes:
+            i = heapq.heappop(self.indexes)
+            html, safe = stash.rawHtmlBlocks[i]
             if self.markdown.safeMode and not safe:
                 if str(self.markdown.safeMode).lower() == 'escape':
                     html = self.escape(html)
@@ -59,13 +116,103 @@ class RawHtmlPostprocessor(Postprocessor):
                     html = ''
                 else:
                     html = self.markdown.html_replacement_text
+            found = self.found[i]
             if self.isblocklevel(html) and (safe or not self.markdown.safeMode):
-                text = text.replace("<p>%s</p>" % 
-                            (self.markdown.htmlStash.get_placeholder(i)),
-                            html + "\n")
-            text =  text.replace(self.markdown.htmlStash.get_placeholder(i), 
-                                 html)
-        return text
+                paragraphs = [piece for piece in found
+                              if self.around(piece, -3) == "<p>" and
+                                 self.around(piece, 4) == "</p>"]
+                for piece in paragraphs:
+                    self.around(piece, -3, remove=True)
+                    self.around(piece, 4, remove=True)
+                    self.insert(piece, html + "\n", i + 1)
+                paragraphs = set(paragraphs)
+                found = [piece for piece in found if piece not in paragraphs]
+            for piece in found:
+                self.insert(piece, html, i + 1)
+
+        pieces, piece = [], 0
+        while piece is not None:
+            pieces.append(self.pieces[piece])
+            piece = self.next[piece]
+        self.pieces = self.prev = self.next = self.found = self.indexes = None
+        return "".join(pieces)
+
+    def run_fused(self, text):
+        """
+        Run this postprocessor, then what the default
+        AndSubstitutePostprocessor and UnescapePostprocessor do, restoring
+        the entities and the escaped chars in a single scan.
+
+        """
+        return self.UNESCAPE_RE.sub(self.unescape, self.run(text))
+
+    def insert(self, piece, text, first):
+        """
+        Put `text` in place of `piece` (or as the whole text if None). The
+        placeholders it holds from index `first` on get a piece of their own.
+
+        """
+        if piece is None:
+            piece = self.append("", None)
+        end = self.next[piece]
+        pos = 0
+        for m in self.RE.finditer(text):
+            i = int(m.group(1))
+            if first <= i < self.markdown.htmlStash.html_counter:
+                self.pieces[piece] = text[pos:m.start()]
+                placeholder = self.append(m.group(0), piece)
+                if i not in self.found:
+                    self.found[i] = []
+                    heapq.heappush(self.indexes, i)
+                self.found[i].append(placeholder)
+                piece = self.append("", placeholder)
+                pos = m.end()
+        self.pieces[piece] = text[pos:]
+        self.next[piece] = end
+        if end is not None:
+            self.prev[end] = piece
+
+    def append(self, text, prev):
+        """ Add a piece after `prev`. """
+        piece = len(self.pieces)
+        self.pieces.append(text)
+        self.prev.append(prev)
+        self.next.append(None)
+        if prev is not None:
+            self.next[prev] = piece
+        return piece
+
+    def around(self, piece, size, remove=False):
+        """
+        Return the `size` chars after a piece, or before it if negative,
+        possibly removing them.
+
+        """
+        link = self.prev if size < 0 else self.next
+        chars = []
+        count = abs(size)
+        piece = link[piece]
+        while count and piece is not None:
+            text = self.pieces[piece]
+            if size < 0:
+                part = text[max(len(text) - count, 0):]
+                if remove:
+                    self.pieces[piece] = text[:len(text) - len(part)]
+                chars.insert(0, part)
+            else:
+                part = text[:count]
+                if remove:
+                    self.pieces[piece] = text[len(part):]
+                chars.append(part)
+            count -= len(part)
+            piece = link[piece]
+        return "".join(chars)
+
+    def unescape(self, m):
+        """ Restore an entity or an escaped char. """
+        if m.group(1) is None:
+            return "&"
+        return util.int2str(int(m.group(1)))
 
     def escape(self, html):
         """ Basic html escaping """
@@ -87,6 +234,8 @@ class RawHtmlPostprocessor(Postprocessor):
 class AndSubstitutePostprocessor(Postprocessor):
     """ Restore valid entities """
 
+    stream_safe = True
+
     def run(self, text):
         text =  text.replace(util.AMP_SUBSTITUTE, "&")
         return text
@@ -95,6 +244,8 @@ class AndSubstitutePostprocessor(Postprocessor):
 class UnescapePostprocessor(Postprocessor):
     """ Restore escaped chars """
 
+    stream_safe = True
+
     RE = re.compile('%s(\d+)%s' % (util.STX, util.ETX))
 
     def unescape(self, m):
@@ -102,3 +253,8 @@ class UnescapePostprocessor(Postprocessor):
 
     def run(self, text):
         return self.RE.sub(self.unescape, text)
+
+
+# Postprocessors run as one by RawHtmlPostprocessor.run_fused
+FUSED_TYPES = [RawHtmlPostprocessor, AndSubstitutePostprocessor,
+               UnescapePostprocessor]
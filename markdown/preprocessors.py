@@ -10,6 +10,7 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from . import util
 from . import odict
+from collections import deque
 import re
 
 
@@ -142,17 +143,18 @@ class HtmlBlockPreprocessor(Preprocessor):
     def run(self, lines):
         text = "\n".join(lines)
         new_blocks = []
-        text = text.rsplit("\n\n")
+        # Blocks are taken from the front and what follows a closing tag is
+        # put back there, a deque does both in constant time
+        text = deque(text.rsplit("\n\n"))
         items = []
         left_tag = ''
         right_tag = ''
         in_tag = False # flag
 
         while text:
-            block = text[0]
+            block = text.popleft()
             if block.startswith("\n"):
                 block = block[1:]
-            text = text[1:]
 
             if block.startswith("\n"):
                 block = block[1:]
@@ -173,7 +175,7 @@ class HtmlBlockPreprocessor(Preprocessor):
                     if data_index < len(block) \
                         and (util.isBlockLevel(left_tag)
                         or left_tag == '--'): 
-                        text.insert(0, block[data_index:])
+                        text.appendleft(block[data_index:])
                         block = block[:data_index]
 
                     if not (util.isBlockLevel(left_tag) \
@@ -227,7 +229,7 @@ class HtmlBlockPreprocessor(Preprocessor):
                     if data_index < len(block):
                         # we have more text after right_tag
                         items[-1] = block[:data_index]
-                        text.insert(0, block[data_index:])
+                        text.appendleft(block[data_index:])
 
                     in_tag = False
                     if self.markdown_in_raw and 'markdown' in attrs.keys():
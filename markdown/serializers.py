@@ -49,7 +49,8 @@ else:
 PI = util.etree.PI
 ProcessingInstruction = util.etree.ProcessingInstruction
 
-__all__ = ['to_html_string', 'to_xhtml_string']
+__all__ = ['to_html_string', 'to_xhtml_string', 'to_html_pieces',
+           'to_xhtml_pieces']
 
 HTML_EMPTY = ("area", "base", "basefont", "br", "col", "frame", "hr",
               "img", "input", "isindex", "link", "meta" "param")
@@ -203,6 +204,18 @@ def _write_html(root,
     else:
         return _encode("".join(data))
 
+def _iter_html(root, format="html"):
+    # serialize the children of root one at a time, without the tags of
+    # root itself
+    assert root is not None
+    qnames, namespaces = _namespaces(root)
+    if root.text:
+        yield _escape_cdata(root.text)
+    for elem in root:
+        data = []
+        _serialize_html(data.append, elem, qnames, None, format)
+        yield "".join(data)
+
 
 # --------------------------------------------------------------------
 # serialization support
@@ -275,3 +288,9 @@ def to_html_string(element):
 
 def to_xhtml_string(element):
     return _write_html(ElementTree(element).getroot(), format="xhtml")
+
+def to_html_pieces(element):
+    return _iter_html(ElementTree(element).getroot(), format="html")
+
+def to_xhtml_pieces(element):
+    return _iter_html(ElementTree(element).getroot(), format="xhtml")
@@ -3,6 +3,8 @@ from __future__ import absolute_import
 from . import util
 from . import odict
 from . import inlinepatterns
+import bisect
+from timeit import default_timer as clock
 
 
 def build_treeprocessors(md_instance, **kwargs):
@@ -52,6 +54,11 @@ class InlineProcessor(Treeprocessor):
         self.__placeholder_length = 4 + len(self.__placeholder_prefix) \
                                       + len(self.__placeholder_suffix)
         self.__placeholder_re = util.INLINE_PLACEHOLDER_RE
+        self.__patterns = None
+        # Time, chars before and after, attempts and hits of each pattern
+        # while an instrumented document is processed (see
+        # Markdown.instrumented)
+        self.__stats = None
         self.markdown = md
 
     def __makePlaceholder(self, type):
@@ -99,26 +106,47 @@ class InlineProcessor(Treeprocessor):
         """
         if not isinstance(data, util.AtomicString):
             startIndex = 0
-            while patternIndex < len(self.markdown.inlinePatterns):
-                data, matched, startIndex = self.__applyPattern(
-                    self.markdown.inlinePatterns.value_for_index(patternIndex),
-                    data, patternIndex, startIndex)
+            patterns = self.__patterns
+            stats = self.__stats
+            size = len(data)
+            while patternIndex < len(patterns):
+                pattern = patterns[patternIndex]
+                scanner = self.__scanners[patternIndex]
+                if stats is not None:
+                    start, inner = clock(), self.__inner
+                if scanner is not None:
+                    data = self.__scanPattern(pattern, scanner, data,
+                                              patternIndex)
+                    matched = False
+                else:
+                    data, matched, startIndex = self.__applyPattern(
+                        pattern, data, patternIndex, startIndex)
+                if stats is not None:
+                    # The patterns applied to the text of the matches are
+                    # timed on their own
+                    elapsed = clock() - start
+                    stats[patternIndex][0] += elapsed - (self.__inner - inner)
+                    self.__inner = inner + elapsed
+                    if not matched:
+                        stats[patternIndex][1] += size
+                        stats[patternIndex][2] += len(data)
+                        size = len(data)
                 if not matched:
                     patternIndex += 1
         return data
 
-    def __processElementText(self, node, subnode, isText=True):
+    def __processElementText(self, subnode, isText=True):
         """
         Process placeholders in Element.text or Element.tail
         of Elements popped from self.stashed_nodes.
 
         Keywords arguments:
 
-        * node: parent node
         * subnode: processing node
         * isText: bool variable, True - it's text, False - it's tail
 
-        Returns: None
+        Returns: list with the ElementTree elements of the placeholders, for
+        the caller to put in place of the text.
 
         """
         if isText:
@@ -128,17 +156,7 @@ class InlineProcessor(Treeprocessor):
             text = subnode.tail
             subnode.tail = None
 
-        childResult = self.__processPlaceholders(text, subnode)
-
-        if not isText and node is not subnode:
-            pos = node.getchildren().index(subnode)
-            node.remove(subnode)
-        else:
-            pos = 0
-
-        childResult.reverse()
-        for newChild in childResult:
-            node.insert(pos, newChild)
+        return self.__processPlaceholders(text, subnode)
 
     def __processPlaceholders(self, data, parent):
         """
@@ -179,13 +197,7 @@ class InlineProcessor(Treeprocessor):
                         linkText(text)
 
                     if not isString(node): # it's Element
-                        for child in [node] + node.getchildren():
-                            if child.tail:
-                                if child.tail.strip():
-                                    self.__processElementText(node, child,False)
-                            if child.text:
-                                if child.text.strip():
-                                    self.__processElementText(child, child)
+                        self.__processChildren(node)
                     else: # it's just a string
                         linkText(node)
                         strartIndex = phEndIndex
@@ -208,6 +220,86 @@ class InlineProcessor(Treeprocessor):
 
         return result
 
+    def __processChildren(self, node):
+        """
+        Process placeholders in the text and the tails of a node popped
+        from self.stashed_nodes and of its children, rebuilding the children
+        of the node in a single sweep.
+
+        The elements of the text and the tail of the node itself go first,
+        the ones of the tail of a child replace that child.
+
+        """
+        children = node.getchildren()
+        front = []
+        if node.tail and node.tail.strip():
+            front = self.__processElementText(node, False)
+        if node.text and node.text.strip():
+            front = self.__processElementText(node) + front
+        rebuilt = front
+        changed = bool(front)
+        for child in children:
+            if child.tail and child.tail.strip():
+                rebuilt.extend(self.__processElementText(child, False))
+                changed = True
+            else:
+                rebuilt.append(child)
+            if child.text and child.text.strip():
+                child[:0] = self.__processElementText(child)
+        if changed:
+            node[:] = rebuilt
+
+    def __handleMatch(self, pattern, match, patternIndex):
+        """
+        Create the node of a match and process its text with the inline
+        patterns that remain to be applied.
+
+        Returns: the node, or None if the pattern rejected the match.
+
+        """
+        node = pattern.handleMatch(match)
+
+        if node is not None and not isString(node):
+            if not isinstance(node.text, util.AtomicString):
+                # We need to process current node too
+                for child in [node] + node.getchildren():
+                    if not isString(node):
+                        if child.text: 
+                            child.text = self.__handleInline(child.text,
+                                                            patternIndex + 1)
+                        if child.tail:
+                            child.tail = self.__handleInline(child.tail,
+                                                            patternIndex)
+        return node
+
+    def __scanPattern(self, pattern, scanner, data, patternIndex):
+        """
+        Apply a pattern to the text in a single pass (see `_PatternScan`).
+
+        Keyword arguments:
+
+        * pattern: the pattern to be applied
+        * scanner: the `Scanner` of the pattern
+        * data: the text to be processed
+        * patternIndex: index of current pattern
+
+        Returns: String with placeholders instead of ElementTree elements.
+
+        """
+        if scanner.triggers.search(data) is None:
+            return data
+        handleMatch = lambda match: \
+            self.__handleMatch(pattern, match, patternIndex)
+        stashNode = lambda node: self.__stashNode(node, pattern.type())
+        scan = _PatternScan(scanner, data, handleMatch, stashNode)
+        result = scan.run()
+        if self.__stats is not None:
+            self.__stats[patternIndex][3] += scan.tries
+            self.__stats[patternIndex][4] += scan.hits
+        if result is None:
+            return data
+        return result
+
     def __applyPattern(self, pattern, data, patternIndex, startIndex=0):
         """
         Check if the line fits the pattern, create the necessary
@@ -225,27 +317,19 @@ class InlineProcessor(Treeprocessor):
         """
         match = pattern.getCompiledRegExp().match(data[startIndex:])
         leftData = data[:startIndex]
+        if self.__stats is not None:
+            self.__stats[patternIndex][3] += 1
 
         if not match:
             return data, False, 0
 
-        node = pattern.handleMatch(match)
+        node = self.__handleMatch(pattern, match, patternIndex)
+        if node is not None and self.__stats is not None:
+            self.__stats[patternIndex][4] += 1
 
         if node is None:
             return data, True, len(leftData)+match.span(len(match.groups()))[0]
 
-        if not isString(node):
-            if not isinstance(node.text, util.AtomicString):
-                # We need to process current node too
-                for child in [node] + node.getchildren():
-                    if not isString(node):
-                        if child.text: 
-                            child.text = self.__handleInline(child.text,
-                                                            patternIndex + 1)
-                        if child.tail:
-                            child.tail = self.__handleInline(child.tail,
-                                                            patternIndex)
-
         placeholder = self.__stashNode(node, pattern.type())
 
         return "%s%s%s%s" % (leftData,
@@ -270,12 +354,26 @@ class InlineProcessor(Treeprocessor):
 
         """
         self.stashed_nodes = {}
+        patterns = self.markdown.inlinePatterns.ordered_values()
+        if patterns is not self.__patterns:
+            # Patterns without a scanner are matched again after each
+            # replacement
+            self.__scanners = [
+                pattern.getScanner() if hasattr(pattern, 'getScanner')
+                else None for pattern in patterns]
+            self.__patterns = patterns
+        instrument = self.markdown.instrument
+        if instrument:
+            self.__stats = [[0, 0, 0, 0, 0] for pattern in patterns]
+            self.__inner = 0
 
         stack = [tree]
 
         while stack:
             currElement = stack.pop()
             insertQueue = []
+            # The children of currElement, with the elements of their tails
+            children = []
             for child in currElement.getchildren():
                 if child.text and not isinstance(child.text, util.AtomicString):
                     text = child.text
@@ -292,12 +390,14 @@ class InlineProcessor(Treeprocessor):
                         child.tail = dumby.text
                     else:
                         child.tail = None
-                    pos = currElement.getchildren().index(child) + 1
-                    tailResult.reverse()
-                    for newChild in tailResult:
-                        currElement.insert(pos, newChild)
+                    children.append(child)
+                    children.extend(tailResult)
+                else:
+                    children.append(child)
                 if child.getchildren():
                     stack.append(child)
+            if len(children) > len(currElement):
+                currElement[:] = children
 
             for element, lst in insertQueue:
                 if self.markdown.enable_attributes:
@@ -305,7 +405,6 @@ class InlineProcessor(Treeprocessor):
                         element.text = \
                             inlinepatterns.handleAttributes(element.text, 
                                                                     element)
-                i = 0
                 for newChild in lst:
                     if self.markdown.enable_attributes:
                         # Processing attributes
@@ -317,11 +416,162 @@ class InlineProcessor(Treeprocessor):
                             newChild.text = \
                                 inlinepatterns.handleAttributes(newChild.text,
                                                                     newChild)
-                    element.insert(i, newChild)
-                    i += 1
+                element[:0] = lst
+        if instrument:
+            for name, stats in zip(self.markdown.inlinePatterns.keys(),
+                                   self.__stats):
+                instrument('inlinepattern', name, *stats)
+            self.__stats = None
         return tree
 
 
+class _PatternScan(object):
+    """
+    Apply an inline pattern to a text in a single pass, with the same result
+    as matching the whole text again after each replacement.
+
+    The attempts made before a replaced match either failed (no match could
+    start there) or found a match rejected by the pattern, past which the
+    following attempts are restricted. Only the ones that could read the
+    replaced text are tried again: those within the reach of the pattern or,
+    when it is unbounded, within the reach of its prefix for the attempts
+    where the prefix did not match and all the others. The scan then resumes
+    after the placeholder.
+
+    """
+
+    def __init__(self, scanner, data, handleMatch, stashNode):
+        self.scanner = scanner
+        self.data = data
+        self.handleMatch = handleMatch
+        self.stashNode = stashNode
+        # Attempts that did not end with a node, in the order of the text:
+        # (start, cut, end) where cut is where the text matched starts and
+        # end is the end of the match rejected by the pattern, if any
+        self.attempts = []
+        self.starts = []
+        # Indexes of the attempts whose reach is unbounded
+        self.unbounded = []
+        self.texts = {}
+        # Regex match or search calls, and nodes replaced
+        self.tries = self.hits = 0
+
+    def getText(self, cut):
+        text = self.texts.get(cut)
+        if text is None:
+            text = self.texts[cut] = self.data[cut:]
+        return text
+
+    def record(self, start, cut, end=None):
+        """ Record an attempt made at `start`. """
+        if self.scanner.reach is None:
+            prefix = self.scanner.prefix
+            if end is not None or prefix is None or \
+                    prefix.match(self.getText(cut), start - cut):
+                self.unbounded.append(len(self.attempts))
+        self.attempts.append((start, cut, end))
+        self.starts.append(start)
+
+    def truncate(self, index):
+        """ Forget the attempts from `index` on. """
+        del self.attempts[index:]
+        del self.starts[index:]
+        del self.unbounded[bisect.bisect_left(self.unbounded, index):]
+
+    def replace(self, start, end, node):
+        """
+        Replace a match with the placeholder of its node.
+
+        Returns: the end of the placeholder.
+
+        """
+        placeholder = self.stashNode(node)
+        data = self.data
+        if end < len(data) and data.endswith('\n'):
+            # The wrapped expressions leave out the trailing newline
+            tail = data[end:-1]
+        else:
+            tail = data[end:]
+        self.data = "%s%s%s" % (data[:start], placeholder, tail)
+        self.texts = {}
+        return start + len(placeholder)
+
+    def retry(self, changed, resume):
+        """
+        Try again the attempts that could read the text replaced from
+        `changed` on, replacing the matches that now end with a node.
+
+        Returns: where to resume the scan and where the text matched starts.
+
+        """
+        while True:
+            reach = self.scanner.reach or self.scanner.prefix_reach or 0
+            first = bisect.bisect_left(self.starts, changed - reach + 1)
+            if self.scanner.reach is None:
+                indexes = self.unbounded[
+                    :bisect.bisect_left(self.unbounded, first)]
+                indexes.extend(range(first, len(self.attempts)))
+            else:
+                indexes = range(first, len(self.attempts))
+            if indexes:
+                cut = self.attempts[indexes[0]][1]
+            elif self.attempts:
+                start, cut, end = self.attempts[-1]
+                if end is not None:
+                    cut = end
+            else:
+                cut = 0
+            for index in indexes:
+                start, cut, end = self.attempts[index]
+                self.tries += 1
+                match = self.scanner.regex.match(self.getText(cut),
+                                                 start - cut)
+                node = stop = None
+                if match is not None:
+                    node = self.handleMatch(match)
+                    stop = cut + match.end()
+                if node is None and stop == end:
+                    # Same outcome
+                    if end is not None:
+                        cut = end
+                    continue
+                self.truncate(index)
+                if node is None:
+                    self.record(start, cut, stop)
+                    if stop is None:
+                        return start + 1, cut
+                    return stop, stop
+                self.hits += 1
+                resume = self.replace(start, stop, node)
+                changed = start
+                break
+            else:
+                return resume, cut
+
+    def run(self):
+        """ Returns: the text with placeholders, or None if nothing matched. """
+        pos = cut = 0
+        changed = False
+        while True:
+            self.tries += 1
+            match = self.scanner.regex.search(self.getText(cut), pos - cut)
+            if match is None:
+                break
+            start, end = cut + match.start(), cut + match.end()
+            for trigger in self.scanner.triggers.finditer(self.data,
+                                                          pos, start):
+                self.record(trigger.start(), cut)
+            node = self.handleMatch(match)
+            if node is None:
+                self.record(start, cut, end)
+                pos = cut = end
+                continue
+            changed = True
+            self.hits += 1
+            pos, cut = self.retry(start, self.replace(start, end, node))
+        return self.data if changed else None
+
+
 class PrettifyTreeprocessor(Treeprocessor):
     """ Add linebreaks to the html document. """
 
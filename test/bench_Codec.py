@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Created by: Simon Brunet 2013-07-14
+#
+# Notice: Do not in entirety or in part, copy, use, distribute, sell,
+#         reproduce or publish any of that code without prior authorization
+#         of the aforementionned author.
+#
+# Abstract:
+#   Micro-benchmark of the cache representation (see Cache/Codec.py)
+#   Compares the pickled size and the encode/decode time of the db.Model
+#   instances that used to be cached with their compact entries.
+#   Requires the App Engine SDK in the PYTHONPATH:
+#       python test/bench_Codec.py
+#
+###############################################################################
+
+import os, sys
+for path in ['Utilities', 'Application', 'Db', 'Cache']:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', path)))
+
+import timeit
+import cPickle
+
+from google.appengine.ext import testbed
+
+import Db
+import Memcache
+
+from Codec import MailEntry, ContentEntry, UserEntry
+
+# Protocol used by memcache
+PROTOCOL = cPickle.HIGHEST_PROTOCOL
+RUNS = 1000
+
+# Pickle round trip of an entity, compared with the round trip of its entry
+# (conversion from the entity included)
+def Measure(name, entity, codec):
+    oldData = cPickle.dumps(entity, PROTOCOL)
+    newData = cPickle.dumps(codec.Convert(entity).Encode(), PROTOCOL)
+    old = lambda: cPickle.loads(cPickle.dumps(entity, PROTOCOL))
+    new = lambda: codec.Decode(cPickle.loads(
+                      cPickle.dumps(codec.Convert(entity).Encode(), PROTOCOL)))
+    oldTime = timeit.timeit(old, number=RUNS)
+    newTime = timeit.timeit(new, number=RUNS)
+    print '%-8s %8d bytes -> %8d bytes   %8.1f us -> %8.1f us' % \
+          (name, len(oldData), len(newData),
+           oldTime * 1e6 / RUNS, newTime * 1e6 / RUNS)
+
+def main():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+
+    content = Db.Model('MailContent').PutContent(sender='Sim',
+                                                 subject='Benchmark',
+                                                 message='x' * 10000,
+                                                 visible=['Pink', 'Red'])
+    user = Db.Model('User')(key_name='Sim', name='Sim', admin=True)
+    user.put()
+    mails = Db.Model('Mail').PutMails([{'name': 'Sim', 'content': content}
+                                       for i in range(Memcache.INBOX_DEQUE_LENGTH)])
+    inbox = Memcache.UserMails(MailEntry.Convert(mail) for mail in mails)
+
+    print '         pickled size (entity -> entry)  round trip time'
+    Measure('Mail', mails[0], MailEntry)
+    Measure('Content', content, ContentEntry)
+    Measure('User', user, UserEntry)
+    # The inbox deque used to hold the entities themselves
+    oldInbox = cPickle.dumps(mails, PROTOCOL)
+    newInbox = cPickle.dumps(inbox.Encode(), PROTOCOL)
+    print '%-8s %8d bytes -> %8d bytes' % ('Inbox', len(oldInbox), len(newInbox))
+
+    bed.deactivate()
+
+if __name__ == '__main__':
+    main()
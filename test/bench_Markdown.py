@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Created by: Simon Brunet 2013-07-21
+#
+# Notice: Do not in entirety or in part, copy, use, distribute, sell,
+#         reproduce or publish any of that code without prior authorization
+#         of the aforementionned author.
+#
+# Abstract:
+#   Scaling benchmark of the Markdown stages that used to degrade
+#   quadratically on large messages. Each stage is timed on inputs of
+#   doubling size, the time per size should stay about constant:
+#       python test/bench_Markdown.py
+#
+###############################################################################
+
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import timeit
+
+import markdown
+
+SIZES = [1000, 2000, 4000, 8000]
+RUNS = 3
+
+# Html blocks, with text after their closing tag, between paragraphs
+def HtmlBlocks(count):
+    return u'\n\n'.join(u'<div>\nblock %d\n\nmore</div> tail\n\nPara %d *x*' %
+                        (i, i) for i in range(count))
+
+# HtmlBlockPreprocessor
+def RunHtmlBlock(md, text):
+    lines = text.split('\n')
+    preprocessor = md.preprocessors['html_block']
+    def run():
+        md.htmlStash.reset()
+        preprocessor.run(lines)
+    return run
+
+# A strong paragraph with one emphasis and its tail per word, the strong
+# element ends up with a child per word
+def WideTree(count):
+    return u'**%s**' % u' '.join(u'*e%d* t' % i for i in range(count))
+
+# InlineProcessor, on the tree of the block parser
+def RunInline(md, text):
+    lines = text.split('\n')
+    treeprocessor = md.treeprocessors['inline']
+    def run():
+        md.htmlStash.reset()
+        treeprocessor.run(md.parser.parseDocument(lines).getroot())
+    return run
+
+CASES = [('html_block', HtmlBlocks, RunHtmlBlock),
+         ('inline', WideTree, RunInline)]
+
+# Best time of a case for each size
+def Measure(name, generate, prepare):
+    md = markdown.Markdown()
+    print name
+    for size in SIZES:
+        text = generate(size)
+        best = min(timeit.repeat(prepare(md, text), number=1, repeat=RUNS))
+        print '  %8d chars %10.1f ms %8.2f us/char' % \
+              (len(text), best * 1e3, best * 1e6 / len(text))
+
+def main():
+    for case in CASES:
+        Measure(*case)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+# Created by: Simon Brunet 2013-07-27
+#
+# Notice: Do not in entirety or in part, copy, use, distribute, sell,
+#         reproduce or publish any of that code without prior authorization
+#         of the aforementionned author.
+#
+# Abstract:
+#   Stage by stage benchmark of Markdown.convert on a corpus of mail bodies.
+#   Runs with plain Python, the App Engine SDK is not needed. The results
+#   are written as JSON, to be compared with the ones of another commit:
+#       python test/bench_MarkdownStages.py -o new.json --compare old.json
+#
+###############################################################################
+
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import cgi
+import json
+import platform
+import random
+import timeit
+
+import markdown
+from markdown.postprocessors import postprocessor_runs
+
+RUNS = 5
+SEED = 2013
+# Stages slower than that compared to the other results are reported
+THRESHOLD = 1.2
+# Changes of less than that many ms are left out as noise
+NOISE = 0.1
+
+WORDS = ('the', 'meeting', 'report', 'is', 'ready', 'for', 'review', 'and',
+         'we', 'should', 'ship', 'it', 'before', 'friday', 'please', 'check',
+         'numbers', 'in', 'second', 'section', 'thanks', 'again', 'team')
+
+def Sentence(rand, count):
+    return ' '.join(rand.choice(WORDS) for i in range(count)).capitalize() + '.'
+
+# Mail as typically written: short paragraphs with a bit of emphasis and
+# links, a quoted reply and a signature
+def Mail(rand):
+    parts = ['Hi all,']
+    for i in range(8):
+        parts.append('%s *%s* %s [the doc](http://example.com/doc/%d) %s' %
+                     (Sentence(rand, 12), rand.choice(WORDS),
+                      Sentence(rand, 8), i, Sentence(rand, 10)))
+    parts.append('\n'.join('> ' + Sentence(rand, 14) for i in range(6)))
+    parts.append('Cheers,  \nSim\n<sim@example.com>')
+    return '\n\n'.join(parts)
+
+# Reply thread, each reply quoting the previous ones
+def Thread(rand):
+    text = Sentence(rand, 20)
+    for i in range(12):
+        quoted = '\n'.join('> ' + line if line else '>'
+                           for line in text.split('\n'))
+        text = 'On day %d, someone wrote:\n\n%s\n\n%s' % \
+               (i, quoted, Sentence(rand, 20))
+    return text
+
+# One paragraph of 20k chars with inline markup all along
+def LongParagraph(rand):
+    spans = ['*%s*', '**%s**', '`%s`', '[%s](http://example.com)', '%s_x_y',
+             '%s\\*', '%s &amp; co']
+    return ' '.join(rand.choice(spans) % Sentence(rand, 4)
+                    for i in range(800))
+
+# Html mail pasted as is
+def InlineHtml(rand):
+    lines = []
+    for i in range(300):
+        lines.append('<span style="color:red">%s</span> <b>%s</b> &copy; '
+                     '<a href="http://example.com/%d">%s</a><br>' %
+                     (Sentence(rand, 5), rand.choice(WORDS), i,
+                      rand.choice(WORDS)))
+        if i % 10 == 9:
+            lines.append('\n<div class="quote">\n%s\n</div>\n' %
+                         Sentence(rand, 15))
+    return '\n'.join(lines)
+
+# The same, as the views give it: escaped before being rendered
+def EscapedHtml(rand):
+    return cgi.escape(InlineHtml(rand), quote=True)
+
+# Lists nested 6 levels deep
+def DeepLists(rand):
+    lines = []
+    for i in range(60):
+        for depth in range(6):
+            marker = '1.' if depth % 2 else '*'
+            lines.append('    ' * depth + '%s %s' % (marker, Sentence(rand, 6)))
+    return '\n'.join(lines)
+
+# Table of 400 rows (tables extension)
+def Table(rand):
+    lines = ['Name | Count | Comment', '---- | ----: | -------']
+    for i in range(400):
+        lines.append('%s | %d | %s *%s*' % (rand.choice(WORDS), i,
+                                            Sentence(rand, 6),
+                                            rand.choice(WORDS)))
+    return '\n'.join(lines)
+
+# Paragraphs citing many reference links, defined at the end
+def References(rand):
+    parts = []
+    for i in range(100):
+        parts.append('%s [%s][ref%d] and [ref%d][] %s' %
+                     (Sentence(rand, 8), rand.choice(WORDS), i,
+                      (i * 7) % 300, Sentence(rand, 6)))
+    parts.append('\n'.join('[ref%d]: http://example.com/%d "Title %d"' %
+                           (i, i, i) for i in range(300)))
+    return '\n\n'.join(parts)
+
+# Name, text generator and extensions of each document of the corpus
+CORPUS = [
+    ('mail', Mail, []),
+    ('thread', Thread, []),
+    ('long_paragraph', LongParagraph, []),
+    ('inline_html', InlineHtml, []),
+    ('escaped_html', EscapedHtml, []),
+    ('deep_lists', DeepLists, []),
+    ('table', Table, ['tables']),
+    ('references', References, []),
+]
+
+def Documents():
+    for name, generate, extensions in CORPUS:
+        # Each document has its own generator, so that adding one doesn't
+        # change the others
+        rand = random.Random('%d %s' % (SEED, name))
+        yield name, unicode(generate(rand)), extensions
+
+# Markdown.convert, adding the time of each stage to times. The stages are
+# named after the registry they come from and the name of the processor
+# (see Markdown.instrumented).
+def StagedConvert(md, source, times):
+    clock = timeit.default_timer
+    def Add(stage, start):
+        times[stage] = times.get(stage, 0) + clock() - start
+
+    md.lines = source.split('\n')
+    for name in md.preprocessors.keys():
+        start = clock()
+        md.lines = md.preprocessors[name].run(md.lines)
+        Add('preprocessor:' + name, start)
+
+    start = clock()
+    root = md.parser.parseDocument(md.lines).getroot()
+    Add('parser', start)
+
+    for name in md.treeprocessors.keys():
+        start = clock()
+        newRoot = md.treeprocessors[name].run(root)
+        if newRoot:
+            root = newRoot
+        Add('treeprocessor:' + name, start)
+
+    start = clock()
+    output = md.serializer(root)
+    begin = output.index('<%s>' % md.doc_tag) + len(md.doc_tag) + 2
+    end = output.rindex('</%s>' % md.doc_tag)
+    output = output[begin:end].strip()
+    Add('serializer', start)
+
+    # The postprocessors run as one are timed together, as convert does
+    for name, run in postprocessor_runs(md.postprocessors):
+        start = clock()
+        output = run(output)
+        Add('postprocessor:' + name, start)
+    return output.strip()
+
+# Best time of each stage over the runs, in ms
+def Measure(md, text):
+    expected = md.reset().convert(text)
+    best = {}
+    for i in range(RUNS):
+        times = {}
+        output = StagedConvert(md.reset(), text, times)
+        if output != expected:
+            raise AssertionError('The stages no longer match Markdown.convert')
+        for stage, time in times.items():
+            best[stage] = min(best.get(stage, time), time)
+    stages = dict((stage, time * 1e3) for stage, time in best.items())
+    return {'chars': len(text), 'total': sum(stages.values()),
+            'stages': stages}
+
+def Run():
+    documents = {}
+    for name, text, extensions in Documents():
+        md = markdown.Markdown(extensions=extensions)
+        documents[name] = result = Measure(md, text)
+        print '%-16s %8d chars %10.2f ms' % (name, result['chars'],
+                                             result['total'])
+    return {'python': platform.python_version(),
+            'markdown': markdown.version,
+            'runs': RUNS,
+            'documents': documents}
+
+# Print the stages of results whose time changed by more than THRESHOLD
+# from the old ones
+def Compare(old, new):
+    print
+    print 'compared with the older results (ms, new / old)'
+    for name in sorted(new['documents']):
+        if name not in old['documents']:
+            continue
+        oldStages = old['documents'][name]['stages']
+        newStages = new['documents'][name]['stages']
+        for stage in ['total'] + sorted(newStages):
+            if stage == 'total':
+                before = old['documents'][name]['total']
+                after = new['documents'][name]['total']
+            elif stage in oldStages:
+                before, after = oldStages[stage], newStages[stage]
+            else:
+                continue
+            ratio = after / before if before else float('inf')
+            if stage != 'total' and abs(after - before) < NOISE:
+                continue
+            if stage == 'total' or ratio > THRESHOLD or ratio < 1 / THRESHOLD:
+                print '%-16s %-34s %10.2f %10.2f %6.2fx%s' % \
+                      (name, stage, before, after, ratio,
+                       '  slower' if ratio > THRESHOLD else '')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON file of older results')
+    args = parser.parse_args()
+
+    results = Run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            Compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -11,11 +11,20 @@
 #
 ###############################################################################
 
+import os
+import datetime
 import unittest
 from google.appengine.ext import testbed
+from google.appengine.ext import deferred
 
 import Db
+import Codec
+import Render
 import Memcache
+import Migration
+import SendMail
+
+from Parameters import MAX_BATCH_PUT
 
 ################################# UNIT TESTS ##################################
 ###############################################################################
@@ -52,6 +61,16 @@ class UdaUserTest(unittest.TestCase):
         # Verify that user is taken
         self.assertTrue(self.cache.UserTaken(name))
         
+    # Make sure a login with an empty or invalid name finds no user
+    def test_InvalidName(self):
+        Db.Model('UdaUser').CreateUdaUser('Sim', 'test')
+        for name in ['', '__Sim__', 'x' * 600]:
+            self.assertIsNone(self.cache.GetUser(name))
+            self.assertFalse(self.cache.UserTaken(name))
+        users = Db.Model('UdaUser').GetMany(['', 'Sim'])
+        self.assertIsNone(users[0])
+        self.assertEqual(users[1].name, 'Sim')
+        
     # Ensure that the password is not stored as is (!!)
     def test_PasswordEncrypted(self, ):
         name = 'Sim'
@@ -114,7 +133,7 @@ class UserTest(unittest.TestCase):
         
         # Verify that the Udacity group was well maintained
         group = Db.Model('Group').GetGroup('Udacity')
-        self.assertIn(userMem.name, group.users)
+        self.assertIn(userMem.name, group.GetUsers())
         
     # Test groups update
     def test_UpdateGroups(self, ):
@@ -132,6 +151,70 @@ class UserTest(unittest.TestCase):
         userMem = self.cache.GetUser(name)
         self.assertEqual(userMem.groups, groups)
 
+    # Make sure users are keyed by name and can be fetched in batch
+    def test_GetMany(self, ):
+        Db.Model('User').CreateUser('Sim')
+        Db.Model('User').CreateUser('Pink')
+        
+        user = Db.Model('User').get_by_key_name('Sim')
+        self.assertEqual(user.name, 'Sim')
+        
+        users = Db.Model('User').GetMany(['Pink', 'Nobody', 'Sim'])
+        self.assertEqual(users[0].name, 'Pink')
+        self.assertIsNone(users[1])
+        self.assertEqual(users[2].name, 'Sim')
+        
+    # Ensure that users created before the key names are re-keyed
+    def test_MigrateNamedKeys(self, ):
+        # Legacy user, keyed by id
+        Db.Model('User')(name='Sim', admin=True).put()
+        self.assertIsNone(Db.Model('User').get_by_key_name('Sim'))
+        
+        Migration.MigrateNamedKeys('User')
+        
+        user = Db.Model('User').get_by_key_name('Sim')
+        self.assertEqual(user.name, 'Sim')
+        self.assertTrue(user.admin)
+        # The legacy entity is gone
+        self.assertEqual(Db.Query('User').count(), 1)
+
+    # Ensure that many users can be validated at once
+    def test_ValidUsers(self, ):
+        Db.Model('User').CreateUser('Sim')
+        Db.Model('User').CreateUser('Pink')
+        # Pink is only in the Db
+        self.cache.cache.delete('Pink', namespace='User')
+        
+        valid = self.cache.ValidUsers(['Sim', 'Pink', 'Nobody'])
+        self.assertEqual(valid, set(['Sim', 'Pink']))
+        
+        # Pink was put back in memcache
+        self.assertIsNotNone(self.cache.cache.get('Pink', namespace='User'))
+        
+    # Make sure repeated reads of a request are served from process memory
+    def test_LocalCache(self, ):
+        os.environ['REQUEST_LOG_ID'] = 'test_LocalCache'
+        try:
+            Db.Model('User').CreateUser('Sim', True)
+            hits = Memcache.localCache.GetStats()['hits']
+            self.assertTrue(self.cache.IsAdmin('Sim'))
+            self.assertTrue(self.cache.ValidUser('Sim'))
+            self.assertEqual(Memcache.localCache.GetStats()['hits'], hits + 2)
+            
+            # Writes are kept coherent
+            user = Db.Model('User').GetUser('Sim')
+            user.UpdateUserGroups(['Udacity', 'PowerRangers'])
+            self.cache.cache.flush_all()
+            userMem = self.cache.GetUser('Sim')
+            self.assertEqual(userMem.groups, ['Udacity', 'PowerRangers'])
+            
+            # Nothing is kept from one request to the other
+            os.environ['REQUEST_LOG_ID'] = 'test_LocalCache2'
+            self.assertFalse(self.cache.ValidUser('Pink'))
+        finally:
+            del os.environ['REQUEST_LOG_ID']
+            Memcache.localCache.Clear()
+        
 ######## Group #########
 class GroupTest(unittest.TestCase):
     def setUp(self):
@@ -162,8 +245,8 @@ class GroupTest(unittest.TestCase):
         self.assertEqual(name, groupMem.name)
         
         # Verify that users are the same
-        self.assertEqual(groupMem.users, users)
-        self.assertEqual(group.users, users)
+        self.assertEqual(sorted(groupMem.GetUsers()), sorted(users))
+        self.assertEqual(sorted(group.GetUsers()), sorted(users))
         
     # Make sure Group creation is properly done in DB and Memcache
     def test_CreateGroup(self):
@@ -180,8 +263,8 @@ class GroupTest(unittest.TestCase):
         self.assertEqual(name, groupMem.name)
         
         # Verify that users are the same
-        self.assertEqual(groupMem.users, users)
-        self.assertEqual(group.users, users)
+        self.assertEqual(sorted(groupMem.GetUsers()), sorted(users))
+        self.assertEqual(sorted(group.GetUsers()), sorted(users))
         
     # Ensure that you can maintain the Udacity group
     def test_MaintainUdacity(self, ):
@@ -191,14 +274,14 @@ class GroupTest(unittest.TestCase):
         Db.Model('Group').AddUserToUdacity(users[0])
         # Verify that Udacity group has been created
         group = self.cache.GetGroup(name)
-        self.assertIn(users[0], group.users)
+        self.assertIn(users[0], group.GetUsers())
         
         newUser = 'Jessica'
         Db.Model('Group').AddUserToUdacity(newUser)
         users.append(newUser)
         # Verify that Udacity now contains 'Jessica' as well
         group = self.cache.GetGroup(name)
-        self.assertListEqual(sorted(group.users), sorted(users))
+        self.assertListEqual(sorted(group.GetUsers()), sorted(users))
         
         # Add a user to Udacity but through generic method
         newUser = 'Samantha'
@@ -207,13 +290,13 @@ class GroupTest(unittest.TestCase):
         # Verify that Sim is now with Jessica and Samantha
         group = self.cache.GetGroup(name)
         users.append(newUser)
-        self.assertEqual(sorted(group.users), sorted(users))
+        self.assertEqual(sorted(group.GetUsers()), sorted(users))
         
         # Ensure that you cannot put the same person multiple times
         Db.Model('Group').AddUserToUdacity('Sim')
         group = self.cache.GetGroup(name)
         self.assertEqual(len(users),3)
-        self.assertEqual(sorted(group.users), sorted(users))
+        self.assertEqual(sorted(group.GetUsers()), sorted(users))
     
     # Ensure that you can maintain a group
     def test_MaintainGroup(self, ):
@@ -223,9 +306,9 @@ class GroupTest(unittest.TestCase):
         Db.Model('Group').AddUser(name, users[0])
         # Verify that group has been created
         group = self.cache.GetGroup(name)
-        self.assertIn(users[0], group.users)
+        self.assertIn(users[0], group.GetUsers())
         groupMem = self.cache.GetGroup(name)
-        self.assertIn(users[0], groupMem.users)
+        self.assertIn(users[0], groupMem.GetUsers())
         
         newUser = 'Pink'
         Db.Model('User').CreateUser(newUser) # Create new User
@@ -233,7 +316,7 @@ class GroupTest(unittest.TestCase):
         users.append(newUser)
         # Verify that PowerRangers now contains 'Pink' as well
         group = self.cache.GetGroup(name)
-        self.assertListEqual(sorted(group.users), sorted(users))
+        self.assertListEqual(sorted(group.GetUsers()), sorted(users))
         
         # Verify that 'Pink' considers herself as member of PowerRangers
         pink = Db.Model('User').GetUser(newUser)
@@ -243,7 +326,7 @@ class GroupTest(unittest.TestCase):
         Db.Model('Group').AddUser(name, newUser)
         group = self.cache.GetGroup(name)
         self.assertEqual(len(users),2)
-        self.assertListEqual(sorted(group.users), sorted(users))
+        self.assertListEqual(sorted(group.GetUsers()), sorted(users))
         # Make sure she's in Udacity and PowerRangers
         pink = Db.Model('User').GetUser(newUser)
         self.assertIn('Udacity', pink.groups)
@@ -254,12 +337,380 @@ class GroupTest(unittest.TestCase):
         Db.Model('Group').RemoveUser(name, newUser)
         users.remove(newUser)
         groupMem = self.cache.GetGroup(name)
-        self.assertEqual(groupMem.users, users)
+        self.assertEqual(groupMem.GetUsers(), users)
         group = Db.Model('Group').GetGroup(name)
-        self.assertEqual(group.users, users)
+        self.assertEqual(group.GetUsers(), users)
         # Make sure she no longer considers herself part of PR (ouch..)
         pink = Db.Model('User').GetUser(newUser)
         self.assertNotIn(name, pink.groups)
         
+    # Ensure that the members can be paged through
+    def test_PageGroup(self, ):
+        name = 'PowerRangers'
+        users = ['Sim', 'Pink', 'Red', 'Blue', 'Yellow']
+        Db.Model('Group').PutGroup(name, users)
+        
+        paged = []
+        page, cursor = Db.Model('Group').GetUsersPage(name, limit=2)
+        paged += page
+        while cursor:
+            page, cursor = Db.Model('Group').GetUsersPage(name, cursor, 2)
+            self.assertLessEqual(len(page), 2)
+            paged += page
+        self.assertEqual(sorted(paged), sorted(users))
+        
+        # Same thing when streamed
+        members = Db.Model('Group').IterUsers(name)
+        self.assertEqual(sorted(members), sorted(users))
+        
+    # Ensure that a stale copy is served while someone else refills
+    def test_StaleWhileRefill(self, ):
+        name = 'PowerRangers'
+        Db.Model('Group').PutGroup(name, ['Sim'])
+        
+        # Another request is refilling the evicted group
+        self.cache.cache.delete(name, namespace='Group')
+        self.cache.cache.add('lease|' + name, 1, namespace='Group')
+        
+        group = self.cache.GetGroup(name)
+        self.assertEqual(group.name, name)
+        # The refill was left to the lease holder
+        self.assertIsNone(self.cache.cache.get(name, namespace='Group'))
+        
+        # Once the lease is released, the next miss refills it
+        self.cache.cache.delete('lease|' + name, namespace='Group')
+        self.cache.GetGroup(name)
+        self.assertIsNotNone(self.cache.cache.get(name, namespace='Group'))
+        
+######## Mail #########
+class MailTest(unittest.TestCase):
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+        # Then activate the testbed, which prepares the service stubs for use.
+        self.testbed.activate()
+        # Service stubs to use.
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.cache = Memcache.MemcacheMail()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+        
+    # Make sure a bulk delivery is properly done in DB and Memcache
+    def test_PutMails(self):
+        # Pink already looked at her inbox, Sim never did
+        self.cache.GetUserMails('Pink')
+        
+        content = Db.Model('MailContent').PutContent(sender='Red',
+                                                     subject='Hi')
+        data = [{'name':'Sim', 'content':content},
+                {'name':'Pink', 'content':content}]
+        mails = Db.Model('Mail').PutMails(data)
+        self.assertEqual(len(mails), 2)
+        
+        # Verify that they were properly put in memcache
+        for mail in mails:
+            mailMem = self.cache.GetMail(str(mail.key().id()))
+            self.assertEqual(mail.name, mailMem.name)
+        
+        # Verify that Pink's inbox was refreshed
+        deque = self.cache.GetUserMails('Pink')
+        self.assertEqual(len(deque), 1)
+        self.assertEqual(deque[0].GetContentKey(), str(content.key()))
+        
+    # Make sure the content is shared and read back in batch
+    def test_SharedContent(self):
+        content = Db.Model('MailContent').PutContent(sender='Red',
+                                                     visible=['Sim', 'Pink'])
+        mails = Db.Model('Mail').PutMails([{'name':'Sim', 'content':content},
+                                           {'name':'Pink', 'content':content}])
+        keys = [mail.GetContentKey() for mail in mails]
+        self.assertEqual(keys[0], keys[1])
+        
+        # Read from memcache, then from the Db once memcache is flushed
+        for i in range(2):
+            contents = self.cache.GetContents(keys)
+            self.assertEqual([c.sender for c in contents], ['Red', 'Red'])
+            self.cache.cache.flush_all()
+        
+        # The receiver is not in his own CC
+        self.assertEqual(content.GetCc('Sim'), ['Pink'])
+
+    # Make sure the inbox is listed without reading the contents
+    def test_Summary(self):
+        content = Db.Model('MailContent').PutContent(sender='Red',
+                                                     subject='Hi')
+        Db.Model('Mail').PutMail(name='Sim', content=content)
+        # Mail delivered before the summary was kept on the mails
+        Db.Model('Mail').PutMail(name='Sim', content=content.key())
+
+        self.cache.cache.flush_all()
+        deque = self.cache.GetUserMails('Sim')
+        self.assertEqual([m.sender for m in deque], ['Red', 'Red'])
+        self.assertEqual([m.subject for m in deque], ['Hi', 'Hi'])
+
+        # The contents are only read for the old mails
+        Db.Model('Mail').PutMail(name='Pink', content=content, sender='Blue')
+        self.cache.cache.flush_all()
+        deque = self.cache.GetUserMails('Pink')
+        self.assertEqual(deque[0].sender, 'Blue')
+        self.assertEqual(self.cache.cache.get(str(content.key()),
+                                              namespace='MailContent'), None)
+
+    # Make sure a message is only rendered once
+    def test_MarkdownCache(self):
+        text = u'*Hi* Sim'
+        memMarkdown = Memcache.MemcacheMarkdown()
+        html = memMarkdown.GetHtml(text)
+        self.assertEqual(html, Render.RenderMarkdown(text))
+        key = Render.HtmlKey(text)
+        self.assertEqual(self.cache.cache.get(key, namespace='Markdown'), html)
+        
+        # Served from the process when memcache is flushed
+        self.cache.cache.flush_all()
+        self.assertEqual(memMarkdown.GetHtml(text), html)
+        # And from memcache to the other instances
+        self.cache.cache.set(key, 'cached', namespace='Markdown')
+        Memcache.htmlCache.Clear()
+        self.assertEqual(memMarkdown.GetHtml(text), 'cached')
+        Memcache.htmlCache.Clear()
+
+    # Make sure only a compact copy of the mails is cached
+    def test_Codec(self):
+        content = Db.Model('MailContent').PutContent(sender='Red')
+        mail = Db.Model('Mail').PutMail(name='Sim', content=content)
+        id = str(mail.key().id())
+        
+        cached = self.cache.cache.get(id, namespace='Mail')
+        self.assertEqual(type(cached), tuple)
+        self.assertEqual(cached[0], Codec.CACHE_VERSION)
+        
+        mailMem = self.cache.GetMail(id)
+        self.assertEqual(mailMem.id, mail.key().id())
+        self.assertEqual(mailMem.name, 'Sim')
+        self.assertEqual(mailMem.created, mail.created)
+        self.assertFalse(mailMem.viewed)
+        
+        # Anything cached by another version is a miss
+        self.cache.cache.set(id, (0, 'Pink'), namespace='Mail')
+        self.assertEqual(self.cache.GetMail(id).name, 'Sim')
+        
+    # Ensure that deletes are absorbed by the inbox buffer
+    def test_DeleteMails(self):
+        content = Db.Model('MailContent').PutContent(sender='Red')
+        mails = Db.Model('Mail').PutMails([{'name':'Sim', 'content':content}
+                                           for i in range(3)])
+        deque = self.cache.GetUserMails('Sim')
+        self.assertEqual(len(deque), 3)
+        # Sim has less mails than the buffer holds
+        self.assertTrue(deque.complete)
+        
+        ids = [str(mails[1].key().id())]
+        Db.Model('Mail').DeleteMails('Sim', ids)
+        
+        deque = self.cache.GetUserMails('Sim')
+        self.assertEqual(len(deque), 2)
+        self.assertNotIn(mails[1].key().id(), [m.id for m in deque])
+        self.assertEqual(self.cache.GetInboxStats()['absorbed'], 1)
+        self.assertEqual(self.cache.GetInboxStats()['refilled'], 0)
+        
+    # Make sure older mails can be reached page by page
+    def test_GetInbox(self):
+        content = Db.Model('MailContent').PutContent(sender='Red')
+        start = datetime.datetime(2013, 7, 1)
+        data = [{'name':'Sim', 'content':content,
+                 'created':start + datetime.timedelta(minutes=i)}
+                for i in range(25)]
+        Db.Model('Mail').PutMails(data)
+        
+        mails, cursor = self.cache.GetInbox('Sim')
+        self.assertEqual(len(mails), 20)
+        self.assertIsNotNone(cursor)
+        
+        older, cursor = self.cache.GetInbox('Sim', cursor)
+        self.assertEqual(len(older), 5)
+        self.assertIsNone(cursor)
+        # Most recent first, right after the first page
+        self.assertLess(older[0].created, mails[-1].created)
+        self.assertEqual(older[-1].created, start)
+        
+        self.assertRaises(ValueError, self.cache.GetInbox, 'Sim', 'garbage')
+        self.assertRaises(ValueError, self.cache.GetInbox, 'Sim', '123:garbage')
+        
+    # Ensure that the mails delivered before the contents were shared are
+    # still readable, then moved to contents of their own
+    def test_LegacyMail(self):
+        mail = Db.Model('Mail')(name='Sim', sender='Red', subject='Hi',
+                                message='Old', cc=['Pink'])
+        mail.put()
+        id = str(mail.key().id())
+        
+        deque = self.cache.GetUserMails('Sim')
+        self.assertEqual(deque[0].sender, 'Red')
+        self.assertIsNone(deque[0].GetContentKey())
+        content = self.cache.GetMailContent(self.cache.GetMail(id))
+        self.assertEqual(content.message, 'Old')
+        self.assertEqual(content.GetCc('Sim'), ['Pink'])
+        
+        # Running it twice doesn't create another content
+        Migration.MigrateMailContents()
+        Migration.MigrateMailContents()
+        
+        mail = Db.Model('Mail').GetMailById(mail.key().id())
+        self.assertIsNotNone(mail.GetContentKey())
+        self.assertIsNone(mail.message)
+        self.assertEqual(Db.Query('MailContent').count(), 1)
+        content = self.cache.GetMailContent(self.cache.GetMail(id))
+        self.assertEqual(content.message, 'Old')
+        self.assertEqual(content.GetCc('Sim'), ['Pink'])
+        
+######## UnreadCounter #########
+class UnreadCounterTest(unittest.TestCase):
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+        # Then activate the testbed, which prepares the service stubs for use.
+        self.testbed.activate()
+        # Service stubs to use.
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.cache = Memcache.MemcacheUnread()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+        
+    # Make sure the count follows deliveries, views and deletes
+    def test_Count(self):
+        content = Db.Model('MailContent').PutContent(sender='Red')
+        mails = Db.Model('Mail').PutMails([{'name':'Sim', 'content':content}
+                                           for i in range(3)])
+        mails.append(Db.Model('Mail').PutMail(name='Pink', content=content))
+        self.assertEqual(self.cache.GetUnread('Sim'), 3)
+        self.assertEqual(self.cache.GetUnread('Pink'), 1)
+        
+        # Viewing twice only counts once
+        mails[0].SetViewed('Sim')
+        mails[0].SetViewed('Sim')
+        self.assertEqual(self.cache.GetUnread('Sim'), 2)
+        self.assertEqual(Db.Model('UnreadCounter').GetCount('Sim'), 2)
+        
+        # Only the unread deleted mails count
+        ids = [str(mails[0].key().id()), str(mails[1].key().id())]
+        Db.Model('Mail').DeleteMails('Sim', ids)
+        self.assertEqual(self.cache.GetUnread('Sim'), 1)
+        
+        # Pink can't delete Sim's mails
+        Db.Model('Mail').DeleteMails('Pink', [str(mails[2].key().id())])
+        self.assertEqual(self.cache.GetUnread('Sim'), 1)
+        
+    # Ensure that a drifting count gets corrected
+    def test_Reconcile(self):
+        content = Db.Model('MailContent').PutContent(sender='Red')
+        Db.Model('Mail').PutMails([{'name':'Sim', 'content':content}
+                                   for i in range(2)])
+        Db.Model('UnreadCounter').AddCounts({'Sim': 5})
+        self.assertEqual(self.cache.GetUnread('Sim'), 7)
+        
+        self.assertEqual(Db.Model('UnreadCounter').Reconcile('Sim'), 2)
+        self.assertEqual(self.cache.GetUnread('Sim'), 2)
+        self.assertEqual(Db.Model('UnreadCounter').GetCount('Sim'), 2)
+        
+######## MailJob #########
+class MailJobTest(unittest.TestCase):
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+        # Then activate the testbed, which prepares the service stubs for use.
+        self.testbed.activate()
+        # Service stubs to use.
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+        
+    # Make sure the recipients are split in fixed-size shards
+    def test_PutJob(self):
+        recipients = ['Sim', 'Pink', 'Red', 'Blue', 'Yellow']
+        content = Db.Model('MailContent').PutContent(sender='Sim')
+        job = Db.Model('MailJob').PutJob(recipients, 2, content=content)
+        
+        shards = job.GetShards()
+        self.assertEqual(len(shards), 3)
+        self.assertEqual([s.index for s in shards], [0, 1, 2])
+        self.assertEqual(shards[0].recipients, ['Sim', 'Pink'])
+        self.assertEqual(shards[2].recipients, ['Yellow'])
+        
+        # Nothing was delivered yet
+        self.assertEqual(len(job.GetUnfinishedShards()), 3)
+        
+    # Ensure that only the unfinished shards are left to resume
+    def test_MarkDone(self):
+        recipients = ['Sim', 'Pink', 'Red', 'Blue', 'Yellow']
+        content = Db.Model('MailContent').PutContent(sender='Sim')
+        job = Db.Model('MailJob').PutJob(recipients, 2, content=content)
+        
+        job.GetShards()[1].MarkDone()
+        
+        unfinished = job.GetUnfinishedShards()
+        self.assertEqual([s.index for s in unfinished], [0, 2])
+        
+    # Make sure a mail without BCC is delivered to every recipient
+    def test_SendMail(self):
+        Db.Model('User').CreateUser('Sim')
+        Db.Model('User').CreateUser('Pink')
+        Db.Model('User').CreateUser('Red')
+        SendMail.SendMail('Sim', 'Pink', 'Red;;Udacity', '', 'Hi', '*Hello*')
+        
+        for task in self.taskqueue.get_filtered_tasks():
+            deferred.run(task.payload)
+        names = sorted(mail.name for mail in Db.Query('Mail'))
+        self.assertEqual(names, ['Pink', 'Red', 'Sim'])
+        
+    # Make sure more shards than a batched put can hold are all written
+    def test_PutManyShards(self):
+        recipients = ['User%d' % i for i in range(MAX_BATCH_PUT + 1)]
+        content = Db.Model('MailContent').PutContent(sender='Sim')
+        job = Db.Model('MailJob').PutJob(recipients, 1, content=content)
+        
+        self.assertEqual(len(job.GetShards()), MAX_BATCH_PUT + 1)
+        
+    # Ensure that resuming a job only delivers the unfinished shards
+    def test_ResumeMail(self):
+        recipients = ['Sim', 'Pink', 'Red', 'Blue', 'Yellow']
+        content = Db.Model('MailContent').PutContent(sender='Sim')
+        job = Db.Model('MailJob').PutJob(recipients, 2, content=content)
+        job.GetShards()[1].MarkDone()
+        
+        SendMail.ResumeMail(job.key())
+        
+        tasks = self.taskqueue.get_filtered_tasks()
+        self.assertEqual(len(tasks), 2)
+        for task in tasks:
+            deferred.run(task.payload)
+        self.assertEqual(job.GetUnfinishedShards(), [])
+        # Red and Blue were not delivered twice
+        names = sorted(mail.name for mail in Db.Query('Mail'))
+        self.assertEqual(names, ['Pink', 'Sim', 'Yellow'])
+        
+    # Make sure only the jobs left unfinished for a while are resumed
+    def test_ResumeStaleMail(self):
+        content = Db.Model('MailContent').PutContent(sender='Sim')
+        sent = datetime.datetime.now() - datetime.timedelta(days=1)
+        stale = Db.Model('MailJob').PutJob(['Sim', 'Pink'], 1,
+                                           content=content, created=sent)
+        Db.Model('MailJob').PutJob(['Sim', 'Pink'], 1, content=content)
+        
+        SendMail.ResumeStaleMail()
+        
+        tasks = self.taskqueue.get_filtered_tasks()
+        self.assertEqual(len(tasks), 1)
+        deferred.run(tasks[0].payload)
+        self.assertEqual(len(self.taskqueue.get_filtered_tasks()), 3)
+        self.assertEqual(len(stale.GetUnfinishedShards()), 2)
+        
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
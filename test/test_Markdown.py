@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# Created by: Simon Brunet 2013-07-28
+#
+# Notice: Do not in entirety or in part, copy, use, distribute, sell,
+#         reproduce or publish any of that code without prior authorization
+#         of the aforementionned author.
+#
+# Abstract:
+#   Unit tests for the Markdown package. Runs with plain Python, the App
+#   Engine SDK is not needed:
+#       python test/test_Markdown.py
+#
+###############################################################################
+
+import os, sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                             'Application')))
+
+import json
+import shutil
+import tempfile
+import unittest
+
+import markdown
+from markdown.batch import markdownFromFiles
+
+import Render
+
+# Documents converted with each configuration, along with the html they
+# converted to before the inline patterns were applied in a single pass
+# (see inlinepatterns.Scanner), each with a new Markdown instance. That html
+# is the reference, it must not be regenerated to make a change pass.
+CORPUS = os.path.join(os.path.dirname(__file__), 'markdown_corpus.json')
+
+################################# UNIT TESTS ##################################
+###############################################################################
+
+
+######## Conformance #########
+class ConformanceTest(unittest.TestCase):
+    def setUp(self):
+        with open(CORPUS) as f:
+            self.corpus = json.load(f)
+
+    def Configs(self):
+        for config, expected in zip(self.corpus['configs'], self.corpus['html']):
+            config = dict((str(name), value) for name, value in config.items())
+            yield config, zip(self.corpus['documents'], expected)
+
+    # Make sure the corpus still converts to the reference html
+    def test_Corpus(self):
+        failed = []
+        for config, documents in self.Configs():
+            for text, html in documents:
+                if markdown.markdown(text, **config) != html:
+                    failed.append((config, text))
+        self.assertEqual(failed, [])
+
+    # Ensure that an instance reused for all the documents of the corpus
+    # converts each of them as a new one does
+    def test_Reuse(self):
+        failed = []
+        for config, documents in self.Configs():
+            md = markdown.Markdown(**config)
+            for text, html in documents:
+                if md.reset().convert(text) != html:
+                    failed.append((config, text))
+        self.assertEqual(failed, [])
+
+######## Stream #########
+class StreamTest(unittest.TestCase):
+    # Make sure a reused instance still streams a top-level element at a
+    # time, with the same html as convert
+    def test_ConvertStream(self):
+        text = u'# Title\n\n*Hi* &amp; <b>all</b>\n\n<div>\nraw\n</div>\n\n\\*done\\*'
+        md = markdown.Markdown()
+        html = md.convert(text)
+        for i in range(2):
+            pieces = []
+            md.reset().convertStream(text, pieces.append)
+            self.assertEqual(u''.join(pieces), html)
+            self.assertGreater(len(pieces), 1)
+
+######## ConverterPool #########
+class ConverterPoolTest(unittest.TestCase):
+    # Make sure a pooled instance converts each message as a new one would,
+    # without the abbreviations defined by the previous ones
+    def test_Reuse(self):
+        pool = Render.GetConverterPool(['extra'])
+        texts = [u'HTML is *fun*\n\n*[HTML]: Hyper Text',
+                 u'HTML is not [fun][1]\n\n[1]: http://example.com']
+        for text in texts * 2:
+            html = markdown.markdown(text, extensions=['extra'])
+            self.assertEqual(pool.Convert(text), html)
+            pieces = []
+            pool.Convert(text, pieces.append)
+            self.assertEqual(u''.join(pieces), html)
+        # One instance did all the conversions
+        self.assertEqual(len(pool.free), 1)
+
+######## Batch #########
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, 'html')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def Write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def Convert(self, inputs, **kwargs):
+        return markdownFromFiles(inputs, self.output, root=self.dir,
+                                 processes=1, **kwargs)
+
+    # Make sure only the files that changed since the last run, or all of
+    # them once an option changed, are converted again
+    def test_Skip(self):
+        inputs = [self.Write('a.txt', b'*a*'), self.Write('b.txt', b'*b*')]
+        summary = self.Convert(inputs)
+        self.assertEqual((summary['converted'], summary['skipped']), (2, 0))
+        with open(os.path.join(self.output, 'a.html')) as f:
+            self.assertEqual(f.read(), '<p><em>a</em></p>')
+
+        summary = self.Convert(inputs)
+        self.assertEqual((summary['converted'], summary['skipped']), (0, 2))
+
+        self.Write('a.txt', b'**a**')
+        summary = self.Convert(inputs)
+        self.assertEqual((summary['converted'], summary['skipped']), (1, 1))
+        with open(os.path.join(self.output, 'a.html')) as f:
+            self.assertEqual(f.read(), '<p><strong>a</strong></p>')
+
+        summary = self.Convert(inputs, output_format='html5')
+        self.assertEqual((summary['converted'], summary['skipped']), (2, 0))
+
+    # Ensure that the failed files are not counted as converted
+    def test_Failed(self):
+        inputs = [self.Write('a.txt', b'*a*'), self.Write('b.txt', b'\xff')]
+        calls = []
+        summary = self.Convert(inputs,
+                               progress=lambda *args: calls.append(args))
+        self.assertEqual(summary['converted'], 1)
+        self.assertEqual([path for path, error in summary['failed']],
+                         [inputs[1]])
+        # done, total, skipped, failed
+        self.assertEqual(calls[-1][:4], (2, 2, 0, 1))
+
+    # Make sure an input is converted once and that two inputs can't be
+    # written to the same file
+    def test_SameOutput(self):
+        path = self.Write('a.txt', b'*a*')
+        same = os.path.join(self.dir, '.', 'a.txt')
+        summary = self.Convert([path, same])
+        self.assertEqual(summary['converted'], 1)
+
+        other = self.Write('a.md', b'*b*')
+        self.assertRaises(ValueError, self.Convert, [path, other])
+
+    # Make sure the html of a file doesn't depend on the files converted
+    # before it by the same worker
+    def test_Independent(self):
+        inputs = [self.Write('a.txt', b'HTML\n\n*[HTML]: Hyper Text'),
+                  self.Write('b.txt', b'HTML')]
+        self.Convert(inputs, extensions=['extra'])
+        with open(os.path.join(self.output, 'b.html')) as f:
+            self.assertEqual(f.read(), '<p>HTML</p>')
+        with open(os.path.join(self.output, 'a.html')) as f:
+            self.assertIn('<abbr title="Hyper Text">HTML</abbr>', f.read())
+
+if __name__ == '__main__':
+    unittest.main()